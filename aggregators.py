@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+from array import array
+
+
+class Accumulator:
+    # Running statistics of one path over a publish window. Values are folded
+    # in as they are decoded, so memory stays the same however many frames
+    # arrive, and reset() clears the object in place for the next window.
+    # result() is the value published for the window; the base class averages.
+    __slots__ = ('count', 'total', 'min', 'max', 'last')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add(self, value):
+        if self.count:
+            if value < self.min:
+                self.min = value
+            elif value > self.max:
+                self.max = value
+        else:
+            self.min = self.max = value
+        self.count += 1
+        self.total += value
+        self.last = value
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def result(self):
+        return self.mean()
+
+
+class LastAccumulator(Accumulator):
+    __slots__ = ()
+
+    def result(self):
+        return self.last
+
+
+class MinAccumulator(Accumulator):
+    __slots__ = ()
+
+    def result(self):
+        return self.min
+
+
+class MaxAccumulator(Accumulator):
+    __slots__ = ()
+
+    def result(self):
+        return self.max
+
+
+class AnySetAccumulator(MaxAccumulator):
+    # Victron alarm levels are ordered (0 ok, 1 warning, 2 alarm), so an alarm
+    # raised at any point in the window is the highest level seen.
+    __slots__ = ()
+
+
+class EwmaAccumulator(Accumulator):
+    # Exponentially weighted moving average. The average carries over from
+    # one window to the next; only the window statistics are reset.
+    __slots__ = ('alpha', 'ewma')
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.ewma = None
+        super().__init__()
+
+    def add(self, value):
+        Accumulator.add(self, value)
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            self.ewma += self.alpha * (value - self.ewma)
+
+    def result(self):
+        return self.ewma if self.count else None
+
+
+class MedianAccumulator(Accumulator):
+    # Streaming median using the P-square algorithm (Jain & Chlamtac), which
+    # tracks five markers instead of keeping the samples. The first SAMPLES
+    # values of a window are kept in a fixed array and give an exact median;
+    # once it is full the markers are seeded from it.
+    __slots__ = ('samples', 'heights', 'positions', 'desired')
+
+    SAMPLES = 32
+    QUANTILES = (0.0, 0.25, 0.5, 0.75, 1.0)
+
+    def __init__(self):
+        self.samples = array('d', bytes(self.SAMPLES * 8))
+        self.heights = array('d', bytes(5 * 8))
+        self.positions = array('d', bytes(5 * 8))
+        self.desired = array('d', bytes(5 * 8))
+        super().__init__()
+
+    def add(self, value):
+        Accumulator.add(self, value)
+        count = self.count
+        if count <= self.SAMPLES:
+            self.samples[count - 1] = value
+            if count == self.SAMPLES:
+                self._seed_markers()
+            return
+
+        q = self.heights
+        n = self.positions
+        if value < q[0]:
+            q[0] = value
+            k = 0
+        elif value >= q[4]:
+            q[4] = value
+            k = 3
+        else:
+            k = 0
+            while value >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.QUANTILES[i]
+
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def _seed_markers(self):
+        ordered = sorted(self.samples)
+        last = self.SAMPLES - 1
+        for i, quantile in enumerate(self.QUANTILES):
+            position = round(quantile * last)
+            self.heights[i] = ordered[position]
+            self.positions[i] = position
+            self.desired[i] = quantile * last
+
+    def result(self):
+        count = self.count
+        if not count:
+            return None
+        if count >= self.SAMPLES:
+            return self.heights[2]
+        values = sorted(self.samples[:count])
+        middle = count // 2
+        if count % 2:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2
+
+
+REDUCERS = {
+    'mean': Accumulator,
+    'last': LastAccumulator,
+    'min': MinAccumulator,
+    'max': MaxAccumulator,
+    'median': MedianAccumulator,
+    'ewma': EwmaAccumulator,
+    'any': AnySetAccumulator,
+}
+
+
+def make_accumulator(path, config):
+    # Alarms default to 'any', everything else to 'mean'
+    reducer = config.get("reducer", "any" if config.get("type") == "bool" else "mean")
+    if reducer not in REDUCERS:
+        logging.error(f"Unknown reducer '{reducer}' for {path}, using mean")
+        reducer = "mean"
+    if reducer == "ewma":
+        return EwmaAccumulator(config.get("alpha", 0.2))
+    return REDUCERS[reducer]()
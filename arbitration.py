@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+
+from can_source import format_frame_key, frame_key
+
+# Seconds without a frame from the active CAN id of a path before it fails
+# over to the next fresh one
+FAILOVER_TIMEOUT = 3
+
+
+class SourceArbiter:
+    # Picks the CAN id each path takes its values from when several ids
+    # feed it, such as the standard and extended id of the same BMS data.
+    # Candidates are ordered by the "priority" of their entry, lowest first,
+    # then by their order in the mapping file. The active id is the first
+    # candidate that was seen within the failover timeout; while none is,
+    # the current one is kept. Frames of standby ids are not decoded, but
+    # their freshness is still recorded so a failover can happen at once.
+    def __init__(self, mappings, previous=None, failover=FAILOVER_TIMEOUT):
+        self.failover = failover
+        candidates = {}
+        for order, (can_id, mapping) in enumerate(mappings.items()):
+            key = frame_key(can_id)
+            for path, config in mapping.items():
+                candidates.setdefault(path, []).append((config.get("priority", 0), order, key))
+        self.candidates = {path: tuple(key for _, _, key in sorted(keys))
+                           for path, keys in candidates.items() if len(keys) > 1}
+        self.active = {}
+        for path, keys in self.candidates.items():
+            active = previous.active.get(path) if previous is not None else None
+            self.active[path] = active if active in keys else keys[0]
+        self.switches = previous.switches if previous is not None else 0
+        self._standby()
+
+    def _standby(self):
+        # (key, path) pairs whose frames are not decoded
+        self.standby = {(key, path) for path, keys in self.candidates.items()
+                        for key in keys if key != self.active[path]}
+
+    def update(self, seen, now):
+        # Re-evaluate the active ids; True when any path switched
+        failover = self.failover
+        switched = {}
+        for path, keys in self.candidates.items():
+            fresh = next((key for key in keys if key in seen and now - seen[key] <= failover), None)
+            active = self.active[path]
+            if fresh is None or fresh == active:
+                continue
+            switched.setdefault((active, fresh), []).append(path)
+            self.active[path] = fresh
+        for (active, fresh), paths in switched.items():
+            logging.warning(f"Switching {', '.join(paths)} from CAN ID {format_frame_key(active)} "
+                            f"to {format_frame_key(fresh)}")
+            self.switches += 1
+        if switched:
+            self._standby()
+        return bool(switched)
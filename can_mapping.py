@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import marshal
+import os
+import struct
+import sys
+
+from can_source import frame_key
+
+# Size in bytes and signedness of the value types used in can-mappings.json.
+# 'bool' takes its size from the byte list and is tested against 'bit'.
+# 'bits' also reads its bytes as one unsigned value, of which 'length' bits
+# from bit 'shift' up are used, as imported from DBC files.
+TYPES = {
+    'U8': (1, False),
+    'S8': (1, True),
+    'U16': (2, False),
+    'S16': (2, True),
+    'U32': (4, False),
+    'S32': (4, True),
+    'bool': (None, False),
+    'bits': (None, False),
+}
+
+# Top level keys of can-mappings.json that hold a configuration section
+# instead of the mapping of a CAN id
+SECTIONS = ('transmit', 'batteries', 'modules', 'cells', 'dbc')
+
+# Field holding the mux value of a multiplexed frame, for entries that set
+# "mux" without a "multiplexor"
+DEFAULT_MULTIPLEXOR = {"bytes": [0], "type": "U8"}
+# Paths of the decoder that reads the mux value of a multiplexed CAN id
+MULTIPLEXED = ('#mux',)
+
+# Bumped whenever the generated decoders change, so old caches are not used
+CACHE_VERSION = 4
+
+STRUCT_CODES = {
+    (1, False): 'B', (1, True): 'b',
+    (2, False): 'H', (2, True): 'h',
+    (4, False): 'I', (4, True): 'i',
+}
+
+
+class CompiledFrame:
+    # Decoder for one CAN id. decode(data) takes the raw payload and returns
+    # one value per entry in self.paths, or None when the frame is too short.
+    # source, code and formats are what is needed to recreate it from the
+    # cache.
+    def __init__(self, can_id, paths, source, code, formats):
+        self.can_id = can_id
+        self.paths = paths
+        self.source = source
+        self.code = code
+        self.formats = formats
+        namespace = {f"_unpack{n}": struct.Struct(fmt).unpack_from for n, fmt in enumerate(formats)}
+        exec(code, namespace)
+        self.decode = namespace['decode']
+
+
+def field_layout(config):
+    # Return (msb_first_byte_offsets, signed) for a mapping entry
+    bytes_list = config.get("bytes")
+    data_type = config.get("type")
+    if not bytes_list or data_type not in TYPES:
+        raise ValueError(f"needs 'bytes' and a 'type' out of {', '.join(TYPES)}")
+    if any(not isinstance(offset, int) or not 0 <= offset <= 7 for offset in bytes_list):
+        # Checked here so compile_frame() skips just this entry instead of
+        # making every frame of the CAN id too short to decode
+        raise ValueError("bytes must be between 0 and 7")
+    size, signed = TYPES[data_type]
+    if size is not None and size != len(bytes_list):
+        raise ValueError(f"type {data_type} needs {size} bytes, got {len(bytes_list)}")
+    if data_type == "bool" and config.get("bit") is None:
+        # Without a bit a bool is decoded like an unsigned value
+        signed = False
+    if data_type == "bits":
+        shift = config.get("shift", 0)
+        length = config.get("length")
+        if not isinstance(shift, int) or not isinstance(length, int) or shift < 0 or length <= 0:
+            raise ValueError("type bits needs a 'length' and optionally a 'shift'")
+        if shift + length > 8 * len(bytes_list):
+            raise ValueError(f"{length} bits from bit {shift} do not fit in {len(bytes_list)} bytes")
+    offsets = list(bytes_list)
+    if config.get("byte_order") == "reversed":
+        offsets.reverse()
+    return tuple(offsets), signed
+
+
+def _struct_position(offsets):
+    # Offset and byte order character when the bytes form a contiguous struct
+    # field, otherwise None.
+    start = min(offsets)
+    if len(offsets) == 1:
+        return start, None
+    if list(offsets) == list(range(start, start + len(offsets))):
+        return start, '>'
+    if list(offsets) == list(range(start + len(offsets) - 1, start - 1, -1)):
+        return start, '<'
+    return None
+
+
+def _build_structs(fields):
+    # Pack as many fields as possible into one struct per byte order so a
+    # frame is usually decoded with a single unpack_from call. Fields that
+    # overlap an already placed field, or have an odd size, are extracted on
+    # their own.
+    groups = {}
+    leftovers = []
+    for index, (offsets, signed) in enumerate(fields):
+        position = _struct_position(offsets)
+        code = STRUCT_CODES.get((len(offsets), signed))
+        if position is None or code is None:
+            leftovers.append(index)
+            continue
+        start, order = position
+        groups.setdefault(order, []).append((start, len(offsets), code, index))
+
+    # Single byte fields have no byte order, put them with the largest group
+    single = groups.pop(None, [])
+    if single:
+        target = max(groups, key=lambda order: len(groups[order]), default='<')
+        groups.setdefault(target, []).extend(single)
+
+    structs = []
+    for order, members in groups.items():
+        members.sort()
+        fmt = order
+        pos = 0
+        placed = []
+        for start, size, code, index in members:
+            if start < pos:
+                leftovers.append(index)
+                continue
+            if start > pos:
+                fmt += f"{start - pos}x"
+            fmt += code
+            pos = start + size
+            placed.append(index)
+        structs.append((fmt, placed))
+    return structs, leftovers
+
+
+def compile_frame(can_id, mapping):
+    paths = []
+    fields = []
+    field_index = {}
+    expressions = []
+    for path, config in mapping.items():
+        try:
+            layout = field_layout(config)
+        except ValueError as e:
+            logging.error(f"Invalid mapping for {can_id} -> {path}: {e}, skipping")
+            continue
+        if layout not in field_index:
+            field_index[layout] = len(fields)
+            fields.append(layout)
+        var = f"f{field_index[layout]}"
+        bit = config.get("bit")
+        if config.get("type") == "bool" and bit is not None:
+            expr = (f"({config.get('true_value', 2)!r} if {var} & {1 << bit} "
+                    f"else {config.get('false_value', 0)!r})")
+        else:
+            expr = var
+            if config.get("type") == "bits":
+                expr = f"({var} >> {config.get('shift', 0)} & {(1 << config['length']) - 1})"
+                if config.get("signed"):
+                    sign = 1 << (config['length'] - 1)
+                    expr = f"({expr} ^ {sign}) - {sign}"
+            scale = config.get("scale", 1)
+            offset = config.get("offset", 0)
+            if scale != 1:
+                expr = f"({expr}) * {scale!r}"
+            if offset:
+                expr = f"{expr} + {offset!r}"
+        paths.append(path)
+        expressions.append(expr)
+
+    structs, leftovers = _build_structs(fields)
+    min_length = max((max(offsets) + 1 for offsets, _ in fields), default=0)
+    lines = ["def decode(data):",
+             f"    if len(data) < {min_length}:",
+             "        return None"]
+    for n, (fmt, placed) in enumerate(structs):
+        targets = ', '.join(f"f{index}" for index in placed)
+        lines.append(f"    {targets}, = _unpack{n}(data)")
+    for index in leftovers:
+        offsets, signed = fields[index]
+        raw = ', '.join(f"data[{i}]" for i in offsets)
+        lines.append(f"    f{index} = int.from_bytes(bytes(({raw},)), 'big', signed={signed})")
+    lines.append(f"    return ({', '.join(expressions)},)" if expressions else "    return ()")
+    source = '\n'.join(lines) + '\n'
+    code = compile(source, f"<can-mapping {can_id}>", 'exec')
+    return CompiledFrame(can_id, tuple(paths), source, code, tuple(fmt for fmt, _ in structs))
+
+
+def validate_mappings(mappings):
+    # Problems that make a mapping table unusable, as a list of messages.
+    # compile_mappings() skips bad entries; this is for rejecting a file as
+    # a whole.
+    errors = []
+    multiplexors = {}
+    options = {}
+    for can_id, mapping in mappings.items():
+        try:
+            frame_key(can_id)
+        except ValueError:
+            errors.append(f"{can_id}: not a hexadecimal CAN id")
+            continue
+        if not isinstance(mapping, dict):
+            errors.append(f"{can_id}: expected an object with D-Bus paths")
+            continue
+        for path, config in mapping.items():
+            if not path.startswith('/'):
+                errors.append(f"{can_id} -> {path}: not a D-Bus path")
+                continue
+            if not isinstance(config, dict):
+                errors.append(f"{can_id} -> {path}: expected an object")
+                continue
+            try:
+                field_layout(config)
+            except (TypeError, ValueError) as e:
+                errors.append(f"{can_id} -> {path}: {e}")
+                continue
+            if not isinstance(config.get("text", {}), dict):
+                errors.append(f"{can_id} -> {path}: text must map raw values to texts")
+            # Entries of a path from several CAN ids are published as one
+            publishing = (bool(config.get("fast")), config.get("interval"), config.get("reducer"))
+            options.setdefault(path, publishing)
+            if options[path] != publishing:
+                errors.append(f"{can_id} -> {path}: fast, interval and reducer must be the same "
+                              f"for every entry of the path")
+            if "mux" not in config:
+                continue
+            if not isinstance(config["mux"], int) or config["mux"] < 0:
+                errors.append(f"{can_id} -> {path}: mux must be a non-negative integer")
+                continue
+            multiplexor = config.get("multiplexor", DEFAULT_MULTIPLEXOR)
+            try:
+                field_layout(multiplexor)
+            except (AttributeError, TypeError, ValueError) as e:
+                errors.append(f"{can_id} -> {path}: invalid multiplexor: {e}")
+                continue
+            multiplexors.setdefault(can_id, multiplexor)
+            if multiplexors[can_id] != multiplexor:
+                errors.append(f"{can_id} -> {path}: all entries of a CAN id need the same multiplexor")
+    return errors
+
+
+def encode_field(data, config, value):
+    # Write value into the bytearray data at the bytes of a mapping entry,
+    # the reverse of what the decoder does. Returns False when the value does
+    # not fit the field.
+    offsets, signed = field_layout(config)
+    raw = round((value - config.get("offset", 0)) / config.get("scale", 1))
+    if config.get("type") == "bits":
+        # Only the bits of the field change, the rest of its bytes is kept
+        shift = config.get("shift", 0)
+        mask = (1 << config["length"]) - 1
+        low, high = (-(mask + 1) // 2, mask // 2) if config.get("signed") else (0, mask)
+        if not low <= raw <= high:
+            return False
+        current = int.from_bytes(bytes(data[offset] for offset in offsets), 'big')
+        raw = current & ~(mask << shift) | (raw & mask) << shift
+    try:
+        encoded = raw.to_bytes(len(offsets), 'big', signed=signed)
+    except OverflowError:
+        return False
+    for offset, byte in zip(offsets, encoded):
+        data[offset] = byte
+    return True
+
+
+def select_mappings(mappings, can_ids):
+    # The part of the mapping table for the given CAN ids; all of it when
+    # can_ids is None
+    if can_ids is None:
+        return mappings
+    keys = {frame_key(can_id) for can_id in can_ids}
+    return {can_id: mapping for can_id, mapping in mappings.items() if frame_key(can_id) in keys}
+
+
+def select_decoders(decoders, mappings):
+    # The decoders of the CAN ids in mappings, including those of every mux
+    # value of a multiplexed id
+    keys = {frame_key(can_id) for can_id in mappings}
+    return {key: decoder for key, decoder in decoders.items()
+            if (key[0] if isinstance(key, tuple) else key) in keys}
+
+
+def split_sections(document):
+    # Separate the configuration sections from the CAN id mappings
+    sections = {name: document.pop(name) for name in SECTIONS if name in document}
+    return document, sections
+
+
+def decoder_key(name):
+    # Frame handler key of a decoder: the kernel can_id, or (can_id, mux
+    # value) for the decoder of one mux value of a multiplexed frame
+    can_id, _, mux = name.partition('#')
+    if mux:
+        return frame_key(can_id), int(mux)
+    return frame_key(can_id)
+
+
+def compile_mappings(mappings):
+    # Turn the can-mappings.json table into one decoder per kernel can_id.
+    # Entries with a "mux" are only present in frames carrying that mux
+    # value: their can_id gets a decoder that reads the mux value (with
+    # paths MULTIPLEXED) and every mux value a decoder keyed (can_id, mux).
+    # Entries without a "mux" are decoded with every mux value.
+    decoders = {}
+    for can_id, mapping in mappings.items():
+        groups = {}
+        for path, config in mapping.items():
+            mux = config.get("mux")
+            if mux is not None and not isinstance(mux, int):
+                logging.error(f"Invalid mux {mux!r} for {can_id} -> {path}, skipping")
+                continue
+            groups.setdefault(mux, {})[path] = config
+        common = groups.pop(None, {})
+        if not groups:
+            decoders[frame_key(can_id)] = compile_frame(can_id, common)
+            continue
+        first = next(iter(groups.values()))
+        multiplexor = next(iter(first.values())).get("multiplexor", DEFAULT_MULTIPLEXOR)
+        decoders[frame_key(can_id)] = compile_frame(can_id, {MULTIPLEXED[0]: multiplexor})
+        for mux, group in groups.items():
+            name = f"{can_id}#{mux}"
+            decoders[decoder_key(name)] = compile_frame(name, dict(group, **common))
+    return decoders
+
+
+def _cache_key(content):
+    # The cache holds marshalled code objects, which are only valid for the
+    # Python version that wrote them
+    key = hashlib.sha256(content)
+    key.update(f"{CACHE_VERSION} {sys.implementation.cache_tag}".encode())
+    return key.hexdigest()
+
+
+def _file_hash(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def _read_cache(cache_filename, key):
+    try:
+        with open(cache_filename, 'rb') as f:
+            cached = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(cached, dict) or cached.get("key") != key:
+        return None
+    # Files the mapping file refers to, such as a DBC file, must be unchanged too
+    for filename, digest in cached["files"].items():
+        if _file_hash(filename) != digest:
+            return None
+    decoders = {}
+    for can_id, paths, source, code, formats in cached["frames"]:
+        decoders[decoder_key(can_id)] = CompiledFrame(can_id, paths, source, code, formats)
+    return cached["mappings"], cached["sections"], decoders
+
+
+def _write_cache(cache_filename, key, mappings, sections, decoders, files):
+    frames = [(d.can_id, d.paths, d.source, d.code, d.formats) for d in decoders.values()]
+    hashes = {filename: _file_hash(filename) for filename in files}
+    temporary = cache_filename + '.tmp'
+    try:
+        with open(temporary, 'wb') as f:
+            marshal.dump({"key": key, "mappings": mappings, "sections": sections, "frames": frames,
+                          "files": hashes}, f)
+        os.replace(temporary, cache_filename)
+    except (OSError, ValueError) as e:
+        logging.debug(f"Cannot write mapping cache {cache_filename}: {e}")
+
+
+def parse_mappings(content, filename):
+    # Mappings and sections of the mapping file content, and the other files
+    # that were read for it. The signals selected in a "dbc" section are
+    # imported from the DBC file, named relative to the mapping file, and
+    # added to the CAN ids; entries in the mapping file take precedence.
+    import json
+    mappings, sections = split_sections(json.loads(content))
+    files = []
+    if "dbc" in sections:
+        from dbc import dbc_mappings
+        dbc_filename = os.path.join(os.path.dirname(filename), sections["dbc"]["file"])
+        files.append(dbc_filename)
+        can_ids = {frame_key(can_id): can_id for can_id in mappings}
+        for can_id, imported in dbc_mappings(sections["dbc"], dbc_filename).items():
+            mapping = mappings.setdefault(can_ids.get(frame_key(can_id), can_id), {})
+            for path, config in imported.items():
+                mapping.setdefault(path, config)
+    return mappings, sections, files
+
+
+def load_mappings(filename, cache_filename=None):
+    # Read the mapping file and return (mappings, sections, decoders). The
+    # result is cached keyed by a hash of the file, so as long as the file
+    # (and a DBC file it imports) does not change startup skips parsing,
+    # validating and compiling it. A file with invalid entries is rejected
+    # with ValueError, as a reload would reject it, and is not cached.
+    with open(filename, 'rb') as f:
+        content = f.read()
+    key = _cache_key(content)
+    if cache_filename:
+        cached = _read_cache(cache_filename, key)
+        if cached is not None:
+            return cached
+    mappings, sections, files = parse_mappings(content, filename)
+    errors = []
+    # Each battery is validated on its own CAN ids, like on a reload, since
+    # batteries may publish the same paths with different options
+    for battery in sections.get("batteries") or [{}]:
+        can_ids = battery.get("can_ids") if isinstance(battery, dict) else None
+        for error in validate_mappings(select_mappings(mappings, can_ids)):
+            if error not in errors:
+                errors.append(error)
+    if errors:
+        for error in errors:
+            logging.error(f"Invalid mapping {error}")
+        raise ValueError("it has invalid mapping entries")
+    decoders = compile_mappings(mappings)
+    if cache_filename:
+        _write_cache(cache_filename, key, mappings, sections, decoders, files)
+    return mappings, sections, decoders
@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import ctypes
+import ctypes.util
+import errno
+import glob
+import logging
+import os
+import socket
+import struct
+import subprocess
+
+# Flags and masks from linux/can.h. Frame keys used throughout the service are
+# the kernel can_id: the 11 or 29 bit identifier with CAN_EFF_FLAG set for
+# extended frames, so the same key comes out of a raw socket and out of the
+# candump fallback.
+CAN_EFF_FLAG = 0x80000000
+CAN_RTR_FLAG = 0x40000000
+CAN_ERR_FLAG = 0x20000000
+CAN_SFF_MASK = 0x000007FF
+CAN_EFF_MASK = 0x1FFFFFFF
+
+# struct can_frame { canid_t can_id; __u8 can_dlc; __u8 pad, res0, res1; __u8 data[8]; }
+CAN_FRAME = struct.Struct('=IB3x8s')
+# struct can_filter { canid_t can_id; canid_t can_mask; }
+CAN_FILTER = struct.Struct('=II')
+# The kernel refuses more filters than this per raw socket
+CAN_RAW_FILTER_MAX = 512
+ARPHRD_CAN = 280
+
+# struct bcm_msg_head from linux/can/bcm.h; the frames that follow are 8 byte
+# aligned, which the trailing 0q takes care of on 32 bit systems.
+BCM_HEAD = struct.Struct('@3I4l2I0q')
+# bcm_msg_head opcodes and flags
+RX_SETUP = 5
+RX_TIMEOUT = 11
+RX_CHANGED = 12
+SETTIMER = 0x0001
+STARTTIMER = 0x0002
+RX_CHECK_DLC = 0x0040
+RX_ANNOUNCE_RESUME = 0x0100
+# Seconds without a frame before the broadcast manager reports an id as lost
+BCM_RX_TIMEOUT = 5
+
+
+def frame_key(can_id):
+    # candump and can-mappings.json print standard ids with 3 hex digits and
+    # extended ids with 8, e.g. '100' and '00000500'.
+    value = int(can_id, 16)
+    if len(can_id) > 3:
+        value |= CAN_EFF_FLAG
+    return value
+
+
+def format_frame_key(key):
+    if key & CAN_EFF_FLAG:
+        return f"{key & CAN_EFF_MASK:08X}"
+    return f"{key & CAN_SFF_MASK:03X}"
+
+
+def can_filters(keys):
+    # One exact-match (can_id, can_mask) filter per mapped id. The EFF and RTR
+    # flags are part of the mask so a standard id never matches an extended
+    # frame with the same low bits, and remote requests are dropped.
+    filters = []
+    for key in sorted(keys):
+        if key & CAN_EFF_FLAG:
+            filters.append((key, CAN_EFF_FLAG | CAN_RTR_FLAG | CAN_EFF_MASK))
+        else:
+            filters.append((key, CAN_EFF_FLAG | CAN_RTR_FLAG | CAN_SFF_MASK))
+    return filters
+
+
+class InterfaceCounters:
+    # Reads the kernel rx_packets counters of the CAN interfaces a source
+    # listens on. Frames the interface received that never reached us were
+    # dropped by the id filter.
+    def __init__(self, interface):
+        if interface == 'any':
+            self.paths = [os.path.join(os.path.dirname(t), 'statistics', 'rx_packets')
+                          for t in glob.glob('/sys/class/net/*/type') if self._is_can(t)]
+        else:
+            self.paths = [f'/sys/class/net/{interface}/statistics/rx_packets']
+        self.start = self.rx_packets()
+
+    @staticmethod
+    def _is_can(type_path):
+        try:
+            with open(type_path) as f:
+                return int(f.read()) == ARPHRD_CAN
+        except (OSError, ValueError):
+            return False
+
+    def rx_packets(self):
+        total = 0
+        for path in self.paths:
+            try:
+                with open(path) as f:
+                    total += int(f.read())
+            except (OSError, ValueError):
+                pass
+        return total
+
+    def received_since_start(self):
+        return self.rx_packets() - self.start
+
+
+# Upper bound of frames handled per main loop wakeup, so a flood of frames
+# cannot starve the timers
+MAX_FRAMES_PER_READ = 4096
+# Frames received per recvmmsg() call
+RECV_BATCH = 256
+MSG_DONTWAIT = 0x40
+
+
+class _Iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _Msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_Iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _Mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _Msghdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_recvmmsg():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    recvmmsg = libc.recvmmsg
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_Mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+
+class BatchReceiver:
+    # Receives fixed size datagrams into slots of one reusable buffer. With
+    # recvmmsg() a whole batch is read with a single system call; where libc
+    # does not provide it, the slots are filled with recv_into() one by one.
+    def __init__(self, sock, size, batch=RECV_BATCH):
+        self.sock = sock
+        self.size = size
+        self.batch = batch
+        self.buffer = bytearray(size * batch)
+        self.view = memoryview(self.buffer)
+        try:
+            self._recvmmsg = _load_recvmmsg()
+        except (OSError, AttributeError):
+            self._recvmmsg = None
+            return
+        base = ctypes.addressof((ctypes.c_char * len(self.buffer)).from_buffer(self.buffer))
+        self._iovecs = (_Iovec * batch)()
+        self._msgs = (_Mmsghdr * batch)()
+        for i in range(batch):
+            self._iovecs[i].iov_base = base + i * size
+            self._iovecs[i].iov_len = size
+            self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            self._msgs[i].msg_hdr.msg_iovlen = 1
+
+    def receive(self):
+        # Number of datagrams now at the start of self.buffer, 0 when none
+        # are waiting
+        if self._recvmmsg is not None:
+            count = self._recvmmsg(self.sock.fileno(), self._msgs, self.batch, MSG_DONTWAIT, None)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return 0
+                raise OSError(err, os.strerror(err))
+            return count
+        count = 0
+        view = self.view
+        size = self.size
+        while count < self.batch:
+            try:
+                self.sock.recv_into(view[count * size:(count + 1) * size], size)
+            except BlockingIOError:
+                break
+            count += 1
+        return count
+
+
+class CanSource:
+    # Common bookkeeping for the frame sources. can_ids is the set of frame
+    # keys the service decodes; when given, everything else is filtered out
+    # before it reaches Python.
+    #
+    # Sources are non-blocking: the service watches fileno() on the main loop
+    # and calls read_frames() when it is readable, which returns every
+    # (can_id, data) pair available. eof is set once the source has ended.
+    # Sources that can detect a missing id count its timeouts in timeouts and
+    # keep the ids that are currently missing in lost. Sources that set
+    # only_changes do not deliver repeated frames, so the arrival of frames
+    # says nothing about whether an id is still being sent.
+    name = None
+    only_changes = False
+
+    def __init__(self, interface='any', can_ids=None):
+        self.interface = interface
+        self.can_ids = set(can_ids) if can_ids is not None else None
+        self.frames_received = 0
+        self.counters = None
+        self.eof = False
+        self.timeouts = {}
+        self.lost = set()
+
+    def open(self):
+        self.frames_received = 0
+        self.eof = False
+        self.counters = InterfaceCounters(self.interface)
+        self._open()
+
+    def dropped_frames(self):
+        # Frames seen on the interface but filtered out before reaching us
+        if self.can_ids is None or self.counters is None:
+            return 0
+        return max(0, self.counters.received_since_start() - self.frames_received)
+
+
+class SocketCanSource(CanSource):
+    # Reads can_frame structs straight from an AF_CAN raw socket. Interface
+    # 'any' binds to every CAN interface, like 'candump any'; a vcan interface
+    # can be used for testing.
+    name = 'socket'
+
+    def __init__(self, interface='any', can_ids=None):
+        super().__init__(interface, can_ids)
+        self.sock = None
+        self.receiver = None
+
+    def _open(self):
+        self.sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+        try:
+            if self.can_ids is not None:
+                self._set_filters()
+            self.sock.bind(('' if self.interface == 'any' else self.interface,))
+            self.sock.setblocking(False)
+            self.receiver = BatchReceiver(self.sock, CAN_FRAME.size)
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
+        logging.info(f"Opened raw CAN socket on {self.interface}")
+
+    def _set_filters(self):
+        filters = can_filters(self.can_ids)
+        if len(filters) > CAN_RAW_FILTER_MAX:
+            logging.warning(f"{len(filters)} CAN ids exceed the kernel filter limit, receiving all frames")
+            return
+        packed = b''.join(CAN_FILTER.pack(can_id, mask) for can_id, mask in filters)
+        # An empty filter list means receive nothing, which is what we want
+        # when nothing is mapped.
+        self.sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER, packed)
+        logging.info(f"Installed {len(filters)} CAN id filters on the raw socket")
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_frames(self):
+        # Drain the socket in batches and unpack each batch of can_frame
+        # structs in one pass over the receive buffer
+        receiver = self.receiver
+        iter_unpack = CAN_FRAME.iter_unpack
+        frames = []
+        total = 0
+        while total < MAX_FRAMES_PER_READ:
+            count = receiver.receive()
+            if not count:
+                break
+            total += count
+            for can_id, dlc, data in iter_unpack(receiver.view[:count * CAN_FRAME.size]):
+                if can_id & (CAN_RTR_FLAG | CAN_ERR_FLAG):
+                    continue
+                frames.append((can_id, data[:dlc]))
+            if count < receiver.batch:
+                break
+        self.frames_received += total
+        return frames
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class CandumpSource(CanSource):
+    # Fallback for systems without AF_CAN support in Python: parse the text
+    # output of 'candump'.
+    name = 'candump'
+
+    def __init__(self, interface='any', can_ids=None):
+        super().__init__(interface, can_ids)
+        self.proc = None
+        self.partial = b''
+        self.buffer = bytearray(65536)
+
+    def _open(self):
+        # stderr is left to the service log
+        self.proc = subprocess.Popen(['candump', self.candump_argument()], stdout=subprocess.PIPE)
+        os.set_blocking(self.proc.stdout.fileno(), False)
+        self.partial = b''
+        logging.info(f"Started candump on {self.interface}")
+
+    def candump_argument(self):
+        # candump takes filters as <ifname>,<can_id>:<can_mask>,... and sets
+        # the EFF flag itself for 8 digit ids.
+        if self.can_ids is None:
+            return self.interface
+        filters = [f"{format_frame_key(can_id)}:{mask:08X}" for can_id, mask in can_filters(self.can_ids)]
+        if not filters:
+            # Without filters candump would pass everything; only let a
+            # standard id 0 through instead
+            filters = ["000:FFFFFFFF"]
+        return ','.join([self.interface] + filters)
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def read_frames(self):
+        fd = self.proc.stdout.fileno()
+        buffer = self.buffer
+        chunks = [self.partial]
+        while True:
+            try:
+                count = os.readv(fd, [buffer])
+            except BlockingIOError:
+                break
+            if not count:
+                self.eof = True
+                break
+            chunks.append(bytes(buffer[:count]))
+            if count < len(buffer):
+                break
+        lines = b''.join(chunks).split(b'\n')
+        # The last element is an incomplete line, or empty
+        self.partial = lines.pop()
+        frames = []
+        for line in lines:
+            self.frames_received += 1
+            frame = self.parse_line(line.decode('ascii', 'replace'))
+            if frame is not None:
+                frames.append(frame)
+        return frames
+
+    @staticmethod
+    def parse_line(line):
+        parts = line.split()
+        if len(parts) < 4:
+            logging.debug("Malformed CAN line received, skipping")
+            return None
+        data = parts[3:]
+        if data and data[0].startswith('['):
+            data = data[1:]
+        try:
+            return frame_key(parts[1]), bytes.fromhex(''.join(data))
+        except ValueError:
+            # Remote requests and error frames have no hex payload
+            logging.debug(f"Unparsable CAN line: {line.strip()}")
+            return None
+
+    def close(self):
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.terminate()
+                try:
+                    self.proc.wait(timeout=2)
+                except subprocess.TimeoutExpired:
+                    self.proc.kill()
+            self.proc.stdout.close()
+        self.proc = None
+
+
+class BcmCanSource(CanSource):
+    # Uses the CAN broadcast manager to watch the mapped ids. The kernel
+    # compares every frame with the previous one of the same id and only
+    # wakes us when the payload (or length) changed, so BMS frames repeating
+    # the same content cost no Python time at all. It also reports an id
+    # that stops arriving, which gives loss detection per id.
+    name = 'bcm'
+    only_changes = True
+
+    def __init__(self, interface='any', can_ids=None, timeout=BCM_RX_TIMEOUT):
+        super().__init__(interface, can_ids)
+        self.timeout = timeout
+        self.sock = None
+
+    def _open(self):
+        if self.can_ids is None:
+            raise ValueError("The broadcast manager needs the list of mapped CAN ids")
+        self.sock = socket.socket(socket.AF_CAN, socket.SOCK_DGRAM, socket.CAN_BCM)
+        try:
+            self.sock.connect(('' if self.interface == 'any' else self.interface,))
+            for can_id in sorted(self.can_ids):
+                self.sock.send(self._rx_setup(can_id))
+            self.sock.setblocking(False)
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
+        self.lost = set()
+        logging.info(f"Subscribed to {len(self.can_ids)} CAN ids with the broadcast manager on {self.interface}")
+
+    def _rx_setup(self, can_id):
+        # One frame with all data bits set as the content filter: any change
+        # of any byte is reported with RX_CHANGED.
+        seconds = int(self.timeout)
+        microseconds = int((self.timeout - seconds) * 1000000)
+        head = BCM_HEAD.pack(RX_SETUP, SETTIMER | STARTTIMER | RX_CHECK_DLC | RX_ANNOUNCE_RESUME, 0,
+                             seconds, microseconds, 0, 0, can_id, 1)
+        return head + CAN_FRAME.pack(can_id, 8, b'\xff' * 8)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_frames(self):
+        sock = self.sock
+        size = BCM_HEAD.size + CAN_FRAME.size
+        frames = []
+        for _ in range(MAX_FRAMES_PER_READ):
+            try:
+                message = sock.recv(size)
+            except BlockingIOError:
+                break
+            opcode, _, _, _, _, _, _, can_id, nframes = BCM_HEAD.unpack_from(message)
+            if opcode == RX_CHANGED and nframes:
+                self.frames_received += 1
+                frame_id, dlc, data = CAN_FRAME.unpack_from(message, BCM_HEAD.size)
+                if can_id in self.lost:
+                    self.lost.discard(can_id)
+                    logging.info(f"CAN ID {format_frame_key(can_id)} is back")
+                frames.append((frame_id, data[:dlc]))
+            elif opcode == RX_TIMEOUT:
+                self.timeouts[can_id] = self.timeouts.get(can_id, 0) + 1
+                self.lost.add(can_id)
+                logging.warning(f"No frames with CAN ID {format_frame_key(can_id)} for {self.timeout} s")
+        return frames
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+SOURCES = {
+    'socket': SocketCanSource,
+    'candump': CandumpSource,
+    'bcm': BcmCanSource,
+}
+
+
+def open_can_source(interface='any', mode='auto', can_ids=None):
+    # 'auto' prefers the raw socket and falls back to candump when the socket
+    # cannot be opened, e.g. on a Python built without AF_CAN.
+    if mode != 'auto':
+        source = SOURCES[mode](interface, can_ids)
+        source.open()
+        return source
+    try:
+        source = SocketCanSource(interface, can_ids)
+        source.open()
+        return source
+    except (AttributeError, OSError) as e:
+        logging.warning(f"Raw CAN socket unavailable ({e}), falling back to candump")
+    source = CandumpSource(interface, can_ids)
+    source.open()
+    return source
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import socket
+
+from can_mapping import field_layout, encode_field
+from can_source import BCM_HEAD, CAN_FRAME, SETTIMER, STARTTIMER, format_frame_key, frame_key
+
+# bcm_msg_head opcode for cyclic transmission
+TX_SETUP = 1
+
+
+class TransmitFrame:
+    # One cyclic frame from the "transmit" section. data is the current
+    # content: the template from the mapping file with the configured D-Bus
+    # paths written into it.
+    def __init__(self, config, interface):
+        self.can_id = frame_key(config["id"])
+        self.interface = config.get("interface", interface)
+        self.interval = float(config["interval"])
+        self.data = bytearray.fromhex(config.get("data", "00" * 8))
+        if len(self.data) > 8:
+            raise ValueError("data is longer than 8 bytes")
+        self.fields = config.get("fields", {})
+        for path, field in self.fields.items():
+            offsets, _ = field_layout(field)
+            if max(offsets) >= len(self.data):
+                raise ValueError(f"{path} does not fit in {len(self.data)} data bytes")
+
+    def update(self, values):
+        # Write the new values of our paths into the content, True when it
+        # changed. Invalidated paths (an empty array) keep their last value.
+        old = bytes(self.data)
+        for path, field in self.fields.items():
+            value = values.get(path)
+            if not isinstance(value, (int, float)):
+                continue
+            if not encode_field(self.data, field, value):
+                logging.error(f"Value {value} of {path} does not fit in transmit frame "
+                              f"{format_frame_key(self.can_id)}")
+        return self.data != old
+
+    def setup(self, start):
+        # TX_SETUP message for this frame. With start the kernel (re)starts
+        # the cycle; without it only the content is replaced and the next
+        # cyclic transmission picks it up, keeping the timing unchanged.
+        flags = SETTIMER | STARTTIMER if start else 0
+        seconds = int(self.interval)
+        microseconds = int(round((self.interval - seconds) * 1000000))
+        head = BCM_HEAD.pack(TX_SETUP, flags, 0, 0, 0, seconds, microseconds, self.can_id, 1)
+        return head + CAN_FRAME.pack(self.can_id, len(self.data), bytes(self.data).ljust(8, b'\0'))
+
+
+class CanTransmitter:
+    # Sends keepalive and polling frames that some BMS need before they
+    # stream data. The broadcast manager repeats every frame in the kernel at
+    # its interval, so no Python wakeups are involved. Frames with fields get
+    # their content refreshed from published D-Bus values through update().
+    def __init__(self, interface, entries):
+        self.frames = []
+        for config in entries:
+            try:
+                frame = TransmitFrame(config, interface)
+            except KeyError as e:
+                logging.error(f"Transmit entry {config} is missing {e}, skipping")
+                continue
+            except ValueError as e:
+                logging.error(f"Invalid transmit entry {config}: {e}, skipping")
+                continue
+            if frame.interface == 'any':
+                logging.error(f"Transmit frame {format_frame_key(frame.can_id)} needs an interface, skipping")
+                continue
+            self.frames.append(frame)
+        self.sockets = {}
+
+    def open(self):
+        for frame in self.frames:
+            sock = self.sockets.get(frame.interface)
+            try:
+                if sock is None:
+                    sock = socket.socket(socket.AF_CAN, socket.SOCK_DGRAM, socket.CAN_BCM)
+                    try:
+                        sock.connect((frame.interface,))
+                    except OSError:
+                        sock.close()
+                        raise
+                    self.sockets[frame.interface] = sock
+                sock.send(frame.setup(True))
+            except (AttributeError, OSError) as e:
+                logging.error(f"Cannot transmit {format_frame_key(frame.can_id)} on {frame.interface}: {e}")
+                continue
+            logging.info(f"Transmitting {format_frame_key(frame.can_id)} on {frame.interface} "
+                         f"every {frame.interval} s")
+
+    def update(self, changes):
+        # Called with the changes of every publish
+        if not self.sockets:
+            return
+        values = {path: change['Value'] for path, change in changes.items()}
+        for frame in self.frames:
+            if frame.fields and frame.update(values):
+                sock = self.sockets.get(frame.interface)
+                if sock is None:
+                    continue
+                try:
+                    sock.send(frame.setup(False))
+                except OSError as e:
+                    logging.error(f"Updating transmit frame {format_frame_key(frame.can_id)} failed: {e}")
+
+    def close(self):
+        # Closing a broadcast manager socket also removes its cyclic jobs
+        for sock in self.sockets.values():
+            sock.close()
+        self.sockets = {}
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+from array import array
+from functools import partial
+
+from can_mapping import DEFAULT_MULTIPLEXOR, MULTIPLEXED, compile_mappings, field_layout
+from can_source import frame_key
+from expiry import DEFAULT_TIMEOUT
+from scheduler import DEFAULT_INTERVAL
+
+# Name of the balancing flags in the generated mapping; not a D-Bus path
+BALANCING = '#balancing'
+
+
+class CellTable:
+    # Cell voltages sent in a multiplexed frame where every mux value carries
+    # the next cells_per_frame cells as 16 bit values. The raw values are
+    # kept in an array('H') with one slot per cell, 0 until a cell was
+    # received, and the balancing flags as a bit mask. values() only returns
+    # the cells and flags that changed since the last publish.
+    def __init__(self, config):
+        self.config = config
+        self.count = int(config["count"])
+        if self.count <= 0:
+            raise ValueError("no cells")
+        per_frame = int(config.get("cells_per_frame", 3))
+        first_byte = int(config.get("first_byte", 1))
+        if per_frame <= 0 or first_byte < 0 or first_byte + 2 * per_frame > 8:
+            raise ValueError("cells do not fit in 8 data bytes")
+        self.scale = config.get("scale", 0.001)
+        self.precision = config.get("precision", 3)
+        self.interval = config.get("interval", DEFAULT_INTERVAL)
+        self.timeout = config.get("timeout", DEFAULT_TIMEOUT)
+        multiplexor = config.get("multiplexor", DEFAULT_MULTIPLEXOR)
+        field_layout(multiplexor)
+
+        # The cells become mux entries of a mapping table, so they are
+        # decoded by the same compiled decoders as can-mappings.json
+        can_id = config["can_id"]
+        self.keys = [frame_key(can_id)]
+        self.mappings = {can_id: {}}
+        for n in range(self.count):
+            offset = first_byte + 2 * (n % per_frame)
+            entry = {"bytes": [offset, offset + 1], "type": "U16", "mux": n // per_frame,
+                     "multiplexor": multiplexor}
+            if "byte_order" in config:
+                entry["byte_order"] = config["byte_order"]
+            self.mappings[can_id][f"/Voltages/Cell{n + 1}"] = entry
+        balancing = config.get("balancing")
+        if balancing:
+            # A bit mask with bit n set while cell n + 1 is being balanced
+            field_layout(balancing)
+            self.mappings.setdefault(balancing["can_id"], {})[BALANCING] = {
+                key: value for key, value in balancing.items() if key != "can_id"}
+            if frame_key(balancing["can_id"]) not in self.keys:
+                self.keys.append(frame_key(balancing["can_id"]))
+
+        self.voltages = array('H', bytes(2 * self.count))
+        self.published = array('H', bytes(2 * self.count))
+        # None until the flags were published, then all of them go out
+        self.has_balancing = bool(balancing)
+        self.balancing = 0
+        self.published_balancing = None
+        self.valid = False
+        self.precisions = {f"/Voltages/Cell{n + 1}": self.precision for n in range(self.count)}
+        self.precisions['/Voltages/Sum'] = self.precision
+        self.precisions['/Voltages/Diff'] = self.precision
+        if balancing:
+            self.precisions.update((f"/Balances/Cell{n + 1}", None) for n in range(self.count))
+
+    def handlers(self):
+        # (decoder, sinks) per frame handler key, in the format of the
+        # service's frame handlers. Sinks store a raw cell value in its slot.
+        handlers = {}
+        for key, decoder in compile_mappings(self.mappings).items():
+            if decoder.paths == MULTIPLEXED:
+                handlers[key] = (decoder, None)
+                continue
+            sinks = []
+            for path in decoder.paths:
+                if path == BALANCING:
+                    sinks.append(self._set_balancing)
+                else:
+                    sinks.append(partial(self.voltages.__setitem__, int(path[len('/Voltages/Cell'):]) - 1))
+            handlers[key] = (decoder, tuple(sinks))
+        return handlers
+
+    def _set_balancing(self, mask):
+        self.balancing = int(mask)
+
+    def values(self, seen, now):
+        # Paths to publish: the cells and flags that changed, with the sum
+        # and spread of the received cells. Everything is invalidated once
+        # when the cell frame stops arriving.
+        key = self.keys[0]
+        if key not in seen or now - seen[key] > self.timeout:
+            if not self.valid:
+                return {}
+            self.valid = False
+            self.voltages[:] = self.published[:] = array('H', bytes(2 * self.count))
+            self.balancing = 0
+            self.published_balancing = None
+            return dict.fromkeys(self.precisions)
+        self.valid = True
+        values = {}
+        voltages = self.voltages
+        published = self.published
+        if voltages != published:
+            scale = self.scale
+            for n in range(self.count):
+                if voltages[n] != published[n]:
+                    values[f"/Voltages/Cell{n + 1}"] = voltages[n] * scale
+            published[:] = voltages
+            received = [value for value in voltages if value]
+            if received:
+                values['/Voltages/Sum'] = sum(received) * scale
+                values['/Voltages/Diff'] = (max(received) - min(received)) * scale
+        if self.has_balancing:
+            if self.published_balancing is None:
+                changed = (1 << self.count) - 1
+            else:
+                changed = self.balancing ^ self.published_balancing
+            for n in range(self.count):
+                if changed >> n & 1:
+                    values[f"/Balances/Cell{n + 1}"] = self.balancing >> n & 1
+            self.published_balancing = self.balancing
+        return values
+
+
+def cell_table(config):
+    # CellTable for a "cells" section, None without one or when invalid
+    if not config:
+        return None
+    try:
+        return CellTable(config)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        logging.error(f"Invalid cells section: {e}, ignoring it")
+        return None
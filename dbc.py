@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import re
+import sys
+
+# Bit 31 of a message id in a DBC file marks an extended (29 bit) CAN id
+DBC_EXTENDED = 0x80000000
+# Path prefix of the signals written by the command line generator
+GENERATED_PREFIX = '/Dbc'
+
+MESSAGE = re.compile(r'^BO_\s+(\d+)\s+(\w+)\s*:\s*(\d+)')
+SIGNAL = re.compile(r'^SG_\s+(\w+)\s*(M|m\d+M?)?\s*:\s*(\d+)\|(\d+)@([01])([+-])\s*'
+                    r'\(\s*([^,\s]+)\s*,\s*([^)\s]+)\s*\)\s*\[[^\]]*\]\s*"([^"]*)"')
+VALUES = re.compile(r'^VAL_\s+(\d+)\s+(\w+)\s+(.*);')
+VALUE = re.compile(r'(-?\d+)\s+"([^"]*)"')
+
+
+class Signal:
+    # One SG_ line. start and length are in DBC bit numbering; for
+    # big endian (Motorola) signals start is the most significant bit.
+    def __init__(self, name, start, length, little_endian, signed, factor, offset, unit, mux=None,
+                 multiplexor=False):
+        self.name = name
+        self.start = start
+        self.length = length
+        self.little_endian = little_endian
+        self.signed = signed
+        self.factor = factor
+        self.offset = offset
+        self.unit = unit
+        self.mux = mux
+        self.multiplexor = multiplexor
+        self.values = {}
+
+    def field(self):
+        # Field layout of the signal in the format of can-mappings.json.
+        # Byte aligned signals become plain U8 to S32 fields; anything else
+        # is a 'bits' field that is shifted and masked after reading its bytes.
+        if self.little_endian:
+            first = self.start // 8
+            last = (self.start + self.length - 1) // 8
+            shift = self.start % 8
+        else:
+            msb = self.start // 8 * 8 + 7 - self.start % 8
+            lsb = msb + self.length - 1
+            first = self.start // 8
+            last = lsb // 8
+            shift = (last + 1) * 8 - 1 - lsb
+        if last > 7:
+            raise ValueError(f"signal {self.name} does not fit in 8 data bytes")
+        size = last - first + 1
+        field = {"bytes": list(range(first, last + 1))}
+        if size > 1 and self.little_endian:
+            field["byte_order"] = "reversed"
+        if shift == 0 and self.length == size * 8 and size in (1, 2, 4):
+            field["type"] = f"{'S' if self.signed else 'U'}{self.length}"
+        else:
+            field.update({"type": "bits", "shift": shift, "length": self.length})
+            if self.signed:
+                field["signed"] = True
+        return field
+
+    def entry(self):
+        # Mapping entry with the scaling and value table of the signal
+        entry = self.field()
+        if self.factor != 1:
+            entry["scale"] = self.factor
+        if self.offset != 0:
+            entry["offset"] = self.offset
+        if self.values:
+            entry["text"] = {str(raw): text for raw, text in self.values.items()}
+        return entry
+
+
+class Message:
+    def __init__(self, frame_id, name, length):
+        self.frame_id = frame_id
+        self.name = name
+        self.length = length
+        self.signals = {}
+
+    @property
+    def can_id(self):
+        # CAN id as written in can-mappings.json
+        if self.frame_id & DBC_EXTENDED:
+            return f"{self.frame_id & ~DBC_EXTENDED:08X}"
+        return f"{self.frame_id:03X}"
+
+    def multiplexor(self):
+        return next((signal for signal in self.signals.values() if signal.multiplexor), None)
+
+
+def _number(text):
+    value = float(text)
+    return int(value) if value.is_integer() else value
+
+
+def parse_dbc(text):
+    # Messages of a DBC file by frame id. Only the parts needed for decoding
+    # are read: messages, signals, simple multiplexing and value tables.
+    messages = {}
+    message = None
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        match = MESSAGE.match(line)
+        if match:
+            message = Message(int(match.group(1)), match.group(2), int(match.group(3)))
+            messages[message.frame_id] = message
+            continue
+        if line.startswith('SG_'):
+            match = SIGNAL.match(line)
+            if match is None or message is None:
+                raise ValueError(f"line {number}: cannot parse signal")
+            name, mux = match.group(1), match.group(2)
+            if mux and mux.startswith('m') and mux.endswith('M'):
+                raise ValueError(f"line {number}: extended multiplexing of {name} is not supported")
+            message.signals[name] = Signal(
+                name, int(match.group(3)), int(match.group(4)), match.group(5) == '1', match.group(6) == '-',
+                _number(match.group(7)), _number(match.group(8)), match.group(9),
+                mux=int(mux[1:]) if mux and mux != 'M' else None, multiplexor=mux == 'M')
+            continue
+        match = VALUES.match(line)
+        if match and int(match.group(1)) in messages:
+            signal = messages[int(match.group(1))].signals.get(match.group(2))
+            if signal is not None:
+                signal.values = {int(raw): text for raw, text in VALUE.findall(match.group(3))}
+    return messages
+
+
+def read_dbc(filename):
+    # DBC files are usually Latin-1 or UTF-8; Latin-1 never fails to decode
+    with open(filename, 'rb') as f:
+        return parse_dbc(f.read().decode('latin-1'))
+
+
+def signal_entries(messages, signals=None, prefix=None):
+    # Mapping table for the messages. signals maps "Message.Signal" to a D-Bus
+    # path, or to an object with a "path" and further mapping options. With a
+    # prefix, signals that are not listed are published as
+    # <prefix>/<Message>/<Signal>; without one they are left out.
+    signals = signals or {}
+    mappings = {}
+    for message in messages.values():
+        multiplexor = message.multiplexor()
+        for signal in message.signals.values():
+            if signal.multiplexor:
+                continue
+            options = signals.get(f"{message.name}.{signal.name}")
+            if options is None:
+                if prefix is None:
+                    continue
+                options = {"path": f"{prefix}/{message.name}/{signal.name}"}
+            elif isinstance(options, str):
+                options = {"path": options}
+            entry = signal.entry()
+            if signal.mux is not None:
+                if multiplexor is None:
+                    raise ValueError(f"{message.name}.{signal.name} is multiplexed but "
+                                     f"{message.name} has no multiplexor")
+                entry["mux"] = signal.mux
+                entry["multiplexor"] = multiplexor.field()
+            entry.update((key, value) for key, value in options.items() if key != "path")
+            mappings.setdefault(message.can_id, {})[options["path"]] = entry
+    return mappings
+
+
+def dbc_mappings(section, filename):
+    # Mapping table for the "dbc" section of can-mappings.json
+    try:
+        messages = read_dbc(filename)
+    except ValueError as e:
+        raise ValueError(f"{filename}: {e}") from None
+    return signal_entries(messages, section.get("signals"), section.get("prefix"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a DBC file into can-mappings.json entries')
+    parser.add_argument('dbc', help="DBC file of the BMS")
+    parser.add_argument('--prefix', default=GENERATED_PREFIX,
+                        help=f"D-Bus path prefix of the generated entries (default: {GENERATED_PREFIX})")
+    args = parser.parse_args()
+    try:
+        entries = signal_entries(read_dbc(args.dbc), prefix=args.prefix)
+    except (OSError, ValueError) as e:
+        sys.exit(f"{args.dbc}: {e}")
+    json.dump(entries, sys.stdout, indent=4)
+    print()
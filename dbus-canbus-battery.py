@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import argparse
 import os
-import json
 import logging
+import math
 import sys
-import subprocess
-import threading
 import time
-from vedbus import VeDbusService
+import dbus
+import dbus.bus
+from aggregators import make_accumulator
+from arbitration import SourceArbiter
+from cells import cell_table
+from can_mapping import (MULTIPLEXED, compile_mappings, load_mappings, parse_mappings, select_decoders,
+                         select_mappings, validate_mappings)
+from can_source import format_frame_key, frame_key, open_can_source, SOURCES
+from can_transmit import CanTransmitter
+from expiry import PathExpiry
+from modules import module_table
+from publisher import FastLane, Publisher, fast_paths, make_deadbands, round_to_precision
+from scheduler import PublishScheduler, publish_intervals
+from snapshot import Snapshot
+from ve_utils import exit_on_error
 from gi.repository import GLib
-import platform
 from dbus.mainloop.glib import DBusGMainLoop
 
 # Configure logging to output to stdout so daemontools can capture it
@@ -30,25 +42,124 @@ os.environ['PYTHONPATH'] = '/data/velib_python-master:' + os.environ.get('PYTHON
 # service can find the mappings regardless of the installation directory.
 CAN_MAPPING_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                 'can-mappings.json')
-with open(CAN_MAPPING_PATH) as f:
-    CAN_MAPPINGS = json.load(f)
+# The compiled form is cached next to it and reused while the file is unchanged.
+CAN_MAPPING_CACHE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                 'can-mappings.cache')
+# Sections such as "transmit" are split off; everything else is a CAN id.
+# The decoders are keyed by the kernel can_id (with CAN_EFF_FLAG set for
+# extended ids).
+try:
+    CAN_MAPPINGS, CAN_SECTIONS, CAN_DECODERS = load_mappings(CAN_MAPPING_PATH, CAN_MAPPING_CACHE)
+except (OSError, ValueError) as e:
+    logging.error(f"Cannot load {CAN_MAPPING_PATH}: {e}")
+    sys.exit(1)
+if logging.getLogger().isEnabledFor(logging.DEBUG):
+    import json
     logging.debug(f"Loaded CAN_MAPPINGS: {json.dumps(CAN_MAPPINGS, indent=2)}")
 
+# Last published values, restored at startup so the battery shows up with
+# valid values before the first window closes
+SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'snapshot.bin')
+# Paths computed by the service rather than decoded from a frame
+DERIVED_PATHS = ('/Dc/0/Power', '/InstalledCapacity', '/Capacity')
+
+# D-Bus service name and device instance of a battery that does not set them
+SERVICE_NAME = 'com.victronenergy.battery.canbusbattery'
+DEVICE_INSTANCE = 42
+
 # Time in seconds before the battery is considered disconnected
 CONNECTION_TIMEOUT = 5
+# Interval in seconds for logging CAN receive statistics
+STATS_INTERVAL = 60
+# Seconds without a decoded frame before the CAN source is reopened
+STALL_TIMEOUT = 60
+# Delay in seconds before reopening a failed CAN source, doubled after every
+# attempt that does not bring frames back
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+# Sections of can-mappings.json that are decoded into tables, with the
+# function building a table from the section
+TABLES = {"modules": module_table, "cells": cell_table}
+# Milliseconds to wait after the last change to can-mappings.json before
+# reloading it, so an editor saving in several steps causes one reload
+RELOAD_DEBOUNCE = 1000
+
+
+def battery_configs(sections, interface):
+    # One configuration per battery served by this process. Without a
+    # "batteries" section there is a single battery on the given interface
+    # that decodes every mapped CAN id.
+    batteries = sections.get("batteries")
+    if not batteries:
+        return [{"interface": interface, "device_instance": DEVICE_INSTANCE, "service": SERVICE_NAME,
+                 "can_ids": None, "transmit": sections.get("transmit", []),
+                 "modules": sections.get("modules"), "cells": sections.get("cells")}]
+    for name in ("transmit", "modules", "cells"):
+        if name in sections:
+            logging.warning(f"The top level {name} section is ignored when batteries are configured, "
+                            f"set it under each battery instead")
+    configs = []
+    for battery in batteries:
+        instance = int(battery["device_instance"])
+        if any(config["device_instance"] == instance for config in configs):
+            raise ValueError(f"device instance {instance} is used by more than one battery")
+        for can_id in battery.get("can_ids", ()):
+            frame_key(can_id)
+        configs.append({
+            "interface": battery.get("interface", interface),
+            "device_instance": instance,
+            "service": battery.get("service", f"{SERVICE_NAME}_{instance}"),
+            "can_ids": battery.get("can_ids"),
+            "transmit": battery.get("transmit", []),
+            "modules": battery.get("modules"),
+            "cells": battery.get("cells"),
+        })
+    return configs
+
+
+def process_age():
+    # Seconds since this process was started. Taken from /proc so the time
+    # the interpreter spent before running this script is included.
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+def _discard(value):
+    # Sink of a path whose CAN id is on standby
+    pass
+
     
 class DbusBatteryService:
-    def __init__(self):
-        self.mainloop = DBusGMainLoop(set_as_default=True)
-        self._dbusservice = VeDbusService('com.victronenergy.battery.canbusbattery', register=False)
+    def __init__(self, battery, source='auto', per_item_signals=True, snapshot_path=SNAPSHOT_PATH,
+                 lite_export=False, bus=None):
+        # battery is one entry of battery_configs(): the interface, CAN ids
+        # and D-Bus identity of the battery this service publishes
+        self.battery = battery
+        self.interface = battery["interface"]
+        self.source_mode = source
+        mappings = select_mappings(CAN_MAPPINGS, battery["can_ids"])
+        decoders = select_decoders(CAN_DECODERS, mappings)
+        # The lite export serves all paths from a single D-Bus object. Only
+        # the module of the export in use is imported.
+        if lite_export:
+            from vedbus_lite import LiteDbusService as service_class
+        else:
+            from vedbus import VeDbusService as service_class
+        self._dbusservice = service_class(battery["service"], bus=bus, register=False)
 
         # Set mandatory paths
         self._dbusservice.add_path('/Mgmt/ProcessName', __file__)
-        self._dbusservice.add_path('/Mgmt/ProcessVersion', 'Unknown version, running on Python ' + platform.python_version())
+        self._dbusservice.add_path('/Mgmt/ProcessVersion', 'Unknown version, running on Python ' + '.'.join(map(str, sys.version_info[:3])))
         self._dbusservice.add_path('/Mgmt/Connection', 'BMS-CAN')
 
         # Device and product info
-        self._dbusservice.add_path('/DeviceInstance', 42)
+        self._dbusservice.add_path('/DeviceInstance', battery["device_instance"])
         self._dbusservice.add_path('/ProductId', 0xBA77)
         self._dbusservice.add_path('/ProductName', 'ELPM482-00005')
         self._dbusservice.add_path('/FirmwareVersion', 0)
@@ -80,166 +191,603 @@ class DbusBatteryService:
         for alarm in ['HighVoltage', 'LowVoltage', 'HighTemperature', 'LowTemperature', 'HighChargeCurrent', 'HighDischargeCurrent', 'HighChargeTemperature', 'CellImbalance']:
             self._dbusservice.add_path(f'/Alarms/{alarm}', 0)
 
+        # Per-module frames of a stack and multiplexed cell frames are kept
+        # in tables and published from there
+        tables = self._make_tables(battery)
+
+        # Mapped paths that are not part of the list above are added as
+        # invalid until they get a value; a reload removes them again.
+        self.dynamic_paths = set()
+        paths = [path for can_id in mappings for path in mappings[can_id]]
+        for table in tables.values():
+            paths.extend(table.precisions)
+        for path in paths:
+            if path not in self._dbusservice:
+                self._dbusservice.add_path(path, None, gettextcallback=self._value_text)
+                self.dynamic_paths.add(path)
+
+        # Restored values are in place before the service appears on D-Bus and
+        # stay provisional until frames for them have been received
+        self.snapshot = Snapshot(snapshot_path) if snapshot_path else None
+        restored = {}
+        if self.snapshot is not None:
+            paths = {path for can_id in mappings for path in mappings[can_id]}
+            paths.update(DERIVED_PATHS)
+            restored = self.snapshot.load([path for path in paths if path in self._dbusservice])
+            for path, value in restored.items():
+                self._dbusservice[path] = value
+            if restored:
+                logging.info(f"Restored {len(restored)} values from {snapshot_path}, "
+                             f"provisional until CAN frames arrive")
+        self.provisional = set(restored)
+
         self._dbusservice.register()
+        age = process_age()
+        if age is not None:
+            logging.info(f"D-Bus service registered {age:.2f} s after process start")
+        self.publisher = Publisher(self._dbusservice, per_item_signals)
+        # Alarms and charge limits flagged "fast" skip the window entirely
+        self.fast_lane = FastLane(self.publisher, {})
+        # Cyclic keepalive/request frames are sent by the kernel; fields in
+        # their content follow the published values.
+        self.transmitter = CanTransmitter(self.interface, battery["transmit"])
+        self.transmitter.open()
+        self.publisher.listeners.append(self.transmitter.update)
+        if self.snapshot is not None:
+            self.publisher.listeners.append(self.snapshot.update)
+        self.publisher.listeners.append(self._first_publish)
 
-        self.data_buffer = {path: [] for can_id in CAN_MAPPINGS for path in CAN_MAPPINGS[can_id]}
-        self.precision_buffer = {path: CAN_MAPPINGS[can_id][path].get("precision") for can_id in CAN_MAPPINGS for path in CAN_MAPPINGS[can_id]}
-        self.start_time = time.time()
+        self.mappings = {}
+        self.path_configs = {}
+        self.accumulators = {}
+        self.expiry = None
+        self.arbiter = None
+        self._configure(mappings, decoders, tables)
+        # can-mappings.json is watched and reloaded when it changes; the
+        # watch is set up once the main loop is idle, after startup
+        self.reload_timer = None
+        self.mapping_monitors = []
+        GLib.idle_add(exit_on_error, self._watch_mappings)
 
-        self.installed_capacity = 0
-        self.soc = 0
+        self.installed_capacity = int(restored.get('/InstalledCapacity', 0))
+        self.soc = int(restored.get('/Soc', 0))
+        self.voltage = restored.get('/Dc/0/Voltage')
+        self.current = restored.get('/Dc/0/Current')
         self.last_valid_can_time = None
-        self.last_dbus_update_time = time.time()
+        # Frames decoded so far; the update timer turns a change of this
+        # counter into last_valid_can_time so frames don't read the clock.
+        self.frames_decoded = 0
+        self.frames_seen = 0
+        self.last_frame_time = time.time()
+        self.last_stats_time = time.time()
+        self.last_stats_cpu = time.process_time()
+        self.last_stats_frames = 0
+        # The CAN source is supervised: when it fails it is reopened with
+        # backoff while the D-Bus service stays registered.
+        self.can_source = None
+        self.can_watch = None
+        self.reconnects = 0
+        self.reconnect_delay = RECONNECT_DELAY
+        self.down_since = None
+        self.downtime = 0.0
 
-        threading.Thread(target=self._start_dbus_update_loop).start()
+        # Everything runs on the GLib main loop: the CAN file descriptor is
+        # watched next to the D-Bus connection and the timers, so ingestion,
+        # aggregation and publishing share one thread. Every callback runs
+        # through exit_on_error: GLib only prints an unexpected exception and
+        # drops the source, which would leave the service running with stale
+        # values, so the process exits for daemontools to restart it.
+        logging.info("Starting D-Bus update loop...")
+        GLib.timeout_add(1000, exit_on_error, self._update)
+        self._schedule_flush()
         self._can_listener()
 
-    def _start_dbus_update_loop(self):
-        logging.info("Starting D-Bus update loop...")
-        GLib.timeout_add(1000, self._update)
-        mainloop = GLib.MainLoop()
-        mainloop.run()
+    def _configure(self, mappings, decoders, tables):
+        # Build everything derived from the mapping table and the module and
+        # cell tables, at startup and on every reload. Accumulators and deadbands
+        # of paths whose entry did not change keep their state.
+        configs = {}
+        for can_id in mappings:
+            for path, config in mappings[can_id].items():
+                configs.setdefault(path, config)
+        self.publisher.set_deadbands(make_deadbands(mappings))
+        self.fast_lane.configure(fast_paths(mappings))
+
+        # One accumulator per path, using the reducer named in the mapping and
+        # reset in place after every window. Each decoder gets the bound add
+        # methods for its paths so a decoded frame is folded in without any
+        # dict lookups.
+        accumulators = {}
+        for path, config in configs.items():
+            if path in self.fast_lane.paths:
+                continue
+            accumulator = self.accumulators.get(path)
+            if accumulator is None or config != self.path_configs.get(path):
+                accumulator = make_accumulator(path, config)
+            accumulators[path] = accumulator
+        sinks = {path: accumulator.add for path, accumulator in accumulators.items()}
+        sinks.update((path, fast_path.add) for path, fast_path in self.fast_lane.paths.items())
+        self.accumulators = accumulators
+        self.precision_buffer = {path: config.get("precision") for path, config in configs.items()}
+        self.decoders = decoders
+        self.sinks = sinks
+        intervals = publish_intervals(mappings)
+        table_handlers = {}
+        table_paths = {}
+        for name, table in tables.items():
+            # Frames of a table write into its slots; the paths it publishes
+            # replace mapped paths of the same name
+            for key in decoders.keys() & set(table.keys):
+                logging.warning(f"CAN ID {format_frame_key(key)} is a {name} frame, ignoring its mapping")
+            for path in configs.keys() & table.precisions.keys():
+                logging.warning(f"{path} is computed from the {name}, ignoring its mapping")
+            table_handlers.update(table.handlers())
+            self.precision_buffer.update(table.precisions)
+            intervals.update((path, table.interval) for path in table.precisions)
+            table_paths.update(dict.fromkeys(table.precisions, table))
+        self.table_handlers = table_handlers
+        self.tables = tables
+        self.table_paths = table_paths
+        # Paths are flushed per group at the interval set in the mapping
+        self.scheduler = PublishScheduler(intervals, time.monotonic())
+        # Paths of CAN ids that stop arriving are invalidated after their timeout
+        expiry = PathExpiry(mappings, int(time.monotonic()))
+        if self.expiry is not None:
+            expiry.seen.update(self.expiry.seen)
+        self.expiry = expiry
+        # Paths fed by several CAN ids take their values from one at a time
+        self.arbiter = SourceArbiter(mappings, self.arbiter)
+        self.arbiter.update(expiry.seen, expiry.now)
+        self._build_handlers()
+        self.mappings = mappings
+        self.path_configs = configs
+
+    def _build_handlers(self):
+        # Decoder and sinks per frame key, swapped as a whole so a frame is
+        # always handled by one consistent configuration. The decoder of a
+        # multiplexed CAN id only reads the mux value and has no sinks.
+        # Paths of a standby CAN id get a sink that drops the value, and a
+        # frame whose paths are all standby gets no sinks and is not decoded.
+        standby = self.arbiter.standby
+        handlers = {}
+        for key, decoder in self.decoders.items():
+            if decoder.paths == MULTIPLEXED:
+                handlers[key] = (decoder, None)
+                continue
+            can_key = key[0] if isinstance(key, tuple) else key
+            if all((can_key, path) in standby for path in decoder.paths):
+                handlers[key] = (decoder, ())
+                continue
+            handlers[key] = (decoder, tuple(_discard if (can_key, path) in standby else self.sinks[path]
+                                            for path in decoder.paths))
+        handlers.update(self.table_handlers)
+        self.frame_handlers = handlers
+
+    def _first_publish(self, changes):
+        # Time to first publish: how long after a (re)start the battery shows
+        # fresh values on D-Bus
+        self.publisher.listeners.remove(self._first_publish)
+        age = process_age()
+        if age is not None:
+            logging.info(f"First values published {age:.2f} s after process start")
+
+    def _watch_mappings(self):
+        # The DBC file imported at startup is watched as well
+        from gi.repository import Gio
+        filenames = [CAN_MAPPING_PATH]
+        if "dbc" in CAN_SECTIONS:
+            filenames.append(os.path.join(os.path.dirname(CAN_MAPPING_PATH), CAN_SECTIONS["dbc"]["file"]))
+        for filename in filenames:
+            monitor = Gio.File.new_for_path(filename).monitor_file(Gio.FileMonitorFlags.NONE, None)
+            monitor.connect('changed', self._mapping_changed)
+            self.mapping_monitors.append(monitor)
+        return False
+
+    def _value_text(self, path, value):
+        # Text of a value from the value table of its entry, e.g. imported
+        # from a DBC file; the table is keyed by the raw value
+        config = self.path_configs.get(path, {})
+        text = config.get("text")
+        if text and isinstance(value, (int, float)):
+            raw = round((value - config.get("offset", 0)) / config.get("scale", 1))
+            if str(raw) in text:
+                return text[str(raw)]
+        return str(value)
+
+    def _mapping_changed(self, monitor, file, other_file, event):
+        from gi.repository import Gio
+        if event == Gio.FileMonitorEvent.DELETED:
+            return
+        if self.reload_timer is not None:
+            GLib.source_remove(self.reload_timer)
+        self.reload_timer = GLib.timeout_add(RELOAD_DEBOUNCE, exit_on_error, self._reload_mappings)
+
+    def _reload_mappings(self):
+        # A new mapping file is only used when all of it is valid; otherwise
+        # the current configuration stays in place.
+        self.reload_timer = None
+        try:
+            with open(CAN_MAPPING_PATH, 'rb') as f:
+                mappings, sections, _ = parse_mappings(f.read(), CAN_MAPPING_PATH)
+            batteries = battery_configs(sections, self.interface)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Not reloading {CAN_MAPPING_PATH}: {e}")
+            return False
+        # Interface and D-Bus identity are fixed for the life of the service;
+        # the CAN ids and transmit frames of the battery can change.
+        instance = self.battery["device_instance"]
+        battery = next((b for b in batteries if b["device_instance"] == instance), None)
+        if battery is None:
+            logging.error(f"Not reloading {CAN_MAPPING_PATH}: battery {instance} is no longer configured")
+            return False
+        mappings = select_mappings(mappings, battery["can_ids"])
+        if (mappings == self.mappings and battery["transmit"] == self.battery["transmit"]
+                and all(battery[name] == self.battery[name] for name in TABLES)):
+            return False
+        errors = validate_mappings(mappings)
+        if errors:
+            for error in errors:
+                logging.error(f"Invalid mapping {error}")
+            logging.error(f"Not reloading {CAN_MAPPING_PATH}, keeping the current mappings")
+            return False
+
+        # Tables keep their values while their section is unchanged
+        tables = self._make_tables(battery, self.tables)
+
+        old_paths = self._published_paths()
+        old_keys = set(self.frame_handlers)
+        decoders = compile_mappings(mappings)
+        self._configure(mappings, decoders, tables)
+        self._update_paths(old_paths, self._published_paths())
+        if self.flush_timer is not None:
+            GLib.source_remove(self.flush_timer)
+        self._schedule_flush()
+        if battery["transmit"] != self.battery["transmit"]:
+            self.publisher.listeners.remove(self.transmitter.update)
+            self.transmitter.close()
+            self.transmitter = CanTransmitter(self.interface, battery["transmit"])
+            self.transmitter.open()
+            self.publisher.listeners.append(self.transmitter.update)
+        self.battery = dict(self.battery, can_ids=battery["can_ids"], transmit=battery["transmit"],
+                            **{name: battery[name] for name in TABLES})
+        if set(self.frame_handlers) != old_keys and self.can_source is not None:
+            # The kernel or candump filters follow the mapped ids
+            GLib.source_remove(self.can_watch)
+            self.can_source.close()
+            self.can_source = None
+            self._can_listener()
+        can_ids = sum(1 for key in self.frame_handlers if isinstance(key, int))
+        logging.info(f"Reloaded {CAN_MAPPING_PATH}: {can_ids} CAN ids, "
+                     f"{len(self._published_paths())} paths")
+        return False
+
+    def _make_tables(self, battery, current=None):
+        # Tables for the sections of the battery, reusing the current table
+        # of a section that did not change
+        tables = {}
+        for name, factory in TABLES.items():
+            if current is not None and battery[name] == self.battery[name]:
+                table = current.get(name)
+            else:
+                table = factory(battery[name])
+            if table is not None:
+                tables[name] = table
+        return tables
+
+    def _published_paths(self):
+        # Mapped paths and the paths published from the tables
+        return set(self.path_configs) | set(self.table_paths)
+
+    def _update_paths(self, old_paths, new_paths):
+        # Register paths that are new on the live service. Paths that are no
+        # longer mapped are removed, or invalidated when they are part of the
+        # fixed set of battery paths.
+        invalid = {}
+        with self._dbusservice as context:
+            for path in sorted(new_paths - old_paths):
+                if path not in self._dbusservice:
+                    context.add_path(path, None, gettextcallback=self._value_text)
+                    self.dynamic_paths.add(path)
+                    logging.info(f"Added {path}")
+        for path in sorted(old_paths - new_paths):
+            if path in self.dynamic_paths:
+                del self._dbusservice[path]
+                self.dynamic_paths.discard(path)
+                logging.info(f"Removed {path}")
+            else:
+                invalid[path] = None
+        if invalid:
+            self.publisher.publish(invalid, window=False)
 
     def _can_listener(self):
         logging.info("Starting CAN listener...")
-        # Listen on any available CAN interface instead of a fixed one
-        self.proc = subprocess.Popen(['candump', 'any'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        self._process_can_output()
+        # Listen on any available CAN interface by default. The raw socket is
+        # preferred; candump is only used when the socket cannot be opened.
+        # Only mapped ids are let through; the kernel (or candump) drops the rest.
+        try:
+            keys = [key for key in self.frame_handlers if isinstance(key, int)]
+            self.can_source = open_can_source(self.interface, self.source_mode, keys)
+        except (AttributeError, OSError, ValueError) as e:
+            logging.error(f"Opening the CAN source failed: {e}")
+            self._source_down()
+            return False
+        self.can_watch = GLib.io_add_watch(self.can_source.fileno(), GLib.PRIORITY_DEFAULT,
+                                           GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                                           lambda fd, condition: exit_on_error(self._process_can_output,
+                                                                               fd, condition))
+        logging.info(f"Started processing CAN frames from {self.can_source.name}...")
+        return True
+
+    def _source_down(self):
+        # Close the source and try again later. Only the source is restarted;
+        # the D-Bus service, its paths and the aggregated state are kept.
+        # Errors other than failing to open or read the source still end the
+        # process so daemontools restarts it.
+        if self.can_source is not None:
+            self.can_source.close()
+            self.can_source = None
+        self.can_watch = None
+        if self.down_since is None:
+            self.down_since = time.monotonic()
+        if self._dbusservice['/Connected'] != 0:
+            logging.warning("CAN connection lost")
+            self._dbusservice['/Connected'] = 0
+        logging.warning(f"Reopening the CAN source in {self.reconnect_delay} s")
+        GLib.timeout_add(self.reconnect_delay * 1000, exit_on_error, self._reconnect)
+        self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_MAX_DELAY)
 
-    def _process_can_output(self):
-        logging.info("Started processing CAN output...")
+    def _reconnect(self):
+        self.reconnects += 1
+        # The transmit frames are set up again first: opening them may have
+        # failed because the interface was not up yet, and the kernel drops
+        # the cyclic jobs of an interface that goes away. A BMS that waits for
+        # a heartbeat would otherwise never start streaming.
+        self.transmitter.close()
+        self.transmitter.open()
+        if self._can_listener():
+            downtime = time.monotonic() - self.down_since
+            self.downtime += downtime
+            self.down_since = None
+            self.last_stats_frames = 0
+            self.last_frame_time = time.time()
+            logging.info(f"CAN source reopened after {downtime:.1f} s")
+        return False
+
+    def _process_can_output(self, fd, condition):
+        # Called from the main loop whenever the CAN source is readable; all
+        # frames that are available are handled in one go. Fast lane latency
+        # is measured from here, so it includes reading the frames.
+        received = time.monotonic()
         try:
-            while True:
-                output = self.proc.stdout.readline()
-                if output == '' and self.proc.poll() is not None:
-                    break
-                if output:
-                    logging.debug(f"candump output: {output.strip()}")
-                    parts = output.split()
-                    if len(parts) < 4:
-                        logging.debug("Malformed CAN line received, skipping")
-                        continue
-                    can_id = parts[1]
-                    data = parts[3:]
-                    if data and data[0].startswith('['):
-                        data = data[1:]
-                    logging.debug(f"Parsed CAN ID: {can_id}, Data: {data}")
-                    if can_id in CAN_MAPPINGS:
-                        self._parse_can_data(can_id, data)
-                        self.last_valid_can_time = time.time()
-                    else:
-                        logging.debug(f"CAN ID: {can_id} not present")
-
-                if time.time() - self.start_time >= 2:
-                    self._send_averaged_data()
-                    self.start_time = time.time()
-                    self.data_buffer = {path: [] for can_id in CAN_MAPPINGS for path in CAN_MAPPINGS[can_id]}
-        except KeyboardInterrupt:
-            logging.info("Process interrupted. Stopping the listener.")
-            self.proc.terminate()
-
-    def _parse_can_data(self, can_id, data):
-        mapping = CAN_MAPPINGS.get(can_id, {})
-        for path, config in mapping.items():
-            try:
-                bytes_list = config.get("bytes")
-                data_type = config.get("type")
-                if bytes_list is None or data_type is None:
-                    logging.error(f"Invalid mapping for {can_id} -> {path}, skipping")
+            frames = self.can_source.read_frames()
+        except OSError as e:
+            logging.error(f"Reading from {self.can_source.name} failed: {e}")
+            self._source_down()
+            return False
+        handlers = self.frame_handlers
+        seen = self.expiry.seen
+        tick = self.expiry.now
+        for key, data in frames:
+            handler = handlers.get(key)
+            if handler is None:
+                logging.debug(f"CAN ID: {key:X} not present")
+                continue
+            seen[key] = tick
+            self.frames_decoded += 1
+            if handler[1] is None:
+                # Multiplexed frame: the decoder reads the mux value, which
+                # selects the decoder for the rest of the frame
+                mux = handler[0].decode(data)
+                handler = handlers.get((key, mux[0])) if mux else None
+                if handler is None:
                     continue
-                value = self._extract_value(
-                    data,
-                    bytes_list,
-                    data_type,
-                    config.get("scale", 1),
-                    config.get("byte_order"),
-                    bit=config.get("bit"),
-                    true_value=config.get("true_value", 2),
-                    false_value=config.get("false_value", 0)
-                )
-                logging.debug(f"Parsed {path} from {can_id}: {value}")
-                if value is not None:
-                    self.data_buffer.setdefault(path, []).append(value)
-                    if path not in self.precision_buffer:
-                        self.precision_buffer[path] = config.get("precision")
-            except Exception as e:
-                logging.error(f"Error parsing {path} from CAN ID {can_id}: {e}")
+            # Frames of a standby source have no sinks and are only counted
+            if handler[1]:
+                self._parse_can_data(handler[0], handler[1], data)
+        if self.fast_lane.pending:
+            self.fast_lane.flush(received)
+        if self.can_source.eof:
+            logging.error(f"CAN source {self.can_source.name} ended")
+            self._source_down()
+            return False
+        return True
 
-    def _extract_value(self, data, bytes_list, data_type, scale, byte_order=None, bit=None, true_value=2, false_value=0):
-        try:
-            raw_bytes = [data[i] for i in bytes_list]
-        except IndexError:
-            logging.error(f"Data {data} too short for bytes {bytes_list}")
-            return None
-        if byte_order == "reversed":
-            raw_bytes.reverse()
+    def _parse_can_data(self, decoder, sinks, data):
+        values = decoder.decode(data)
+        if values is None:
+            logging.error(f"Data {data.hex()} too short for CAN ID {decoder.can_id}")
+            return
+        for add, value in zip(sinks, values):
+            add(value)
+
+    def _schedule_flush(self):
+        # Windows are closed by a timer at the next group deadline, so they
+        # close on time even when frames stop arriving.
+        deadline = self.scheduler.next_deadline
+        self.flush_timer = None
+        if deadline is not None:
+            delay = max(0.0, deadline - time.monotonic())
+            self.flush_timer = GLib.timeout_add(math.ceil(delay * 1000), exit_on_error, self._flush_due)
+
+    def _flush_due(self):
+        # The next flush is scheduled even when publishing fails, otherwise
+        # an error in one window would stop all further windows
         try:
-            raw_value = int(''.join(raw_bytes), 16)
-        except ValueError as e:
-            logging.error(f"Invalid hex data {raw_bytes}: {e}")
-            return None
-        if data_type == "bool" and bit is not None:
-            is_bit_set = (raw_value >> bit) & 1
-            return true_value if is_bit_set else false_value
-        if data_type == "S8":
-            raw_value = int.from_bytes(raw_value.to_bytes(1, 'big'), 'big', signed=True)
-        elif data_type == "S16":
-            raw_value = int.from_bytes(raw_value.to_bytes(2, 'big'), 'big', signed=True)
-        scaled_value = raw_value * scale
-        logging.debug(f"Extracted value: raw={raw_value}, scaled={scaled_value}, type={data_type}")
-        return scaled_value
-
-    def _average(self, values):
-        return sum(values) / len(values) if values else None
+            paths = self.scheduler.due(time.monotonic())
+            if paths:
+                self._send_averaged_data(paths)
+        finally:
+            self._schedule_flush()
+        return False
 
     def _calculate_available_capacity(self):
         available_capacity = int(self.installed_capacity * (self.soc / 100))
         logging.info(f"Setting /Capacity (Available Capacity): {available_capacity}")
-        self._dbusservice['/Capacity'] = available_capacity
+        return available_capacity
 
-    def _send_averaged_data(self):
+    def _send_averaged_data(self, paths):
+        # Publish the given paths, which are all groups that are due now
         nr_of_modules_online = None
-        voltage = None
-        current = None
-        updated = False
-        for path, values in self.data_buffer.items():
-            if values:
-                avg_value = self._average(values)
-                precision = self.precision_buffer.get(path)
-                if precision is not None:
-                    avg_value = float(f"{avg_value:.{precision}f}")
-                logging.info(f"Setting averaged {path}: {avg_value}")
-                self._dbusservice[path] = avg_value
-                updated = True
-                logging.debug(f"D-Bus write: {path} = {avg_value}")
+        power_inputs = False
+        values = {}
+        table_values = {}
+        for path in paths:
+            table = self.table_paths.get(path)
+            if table is not None:
+                # The values of a table are computed in one pass when the
+                # first of its paths is due; a table may leave out paths
+                # that did not change
+                if table not in table_values:
+                    table_values[table] = table.values(self.expiry.seen, self.expiry.now)
+                if path in self.accumulators:
+                    self.accumulators[path].reset()
+                if path not in table_values[table]:
+                    continue
+                value = table_values[table][path]
+                if value is not None:
+                    value = round_to_precision(value, self.precision_buffer.get(path))
+                    logging.info(f"Setting {path}: {value}")
+                values[path] = value
+                continue
+            accumulator = self.accumulators[path]
+            if accumulator.count:
+                value = accumulator.result()
+                accumulator.reset()
+                value = round_to_precision(value, self.precision_buffer.get(path))
+                logging.info(f"Setting {path}: {value}")
+                values[path] = value
                 if path == '/Dc/0/Voltage':
-                    voltage = avg_value
+                    self.voltage = value
+                    power_inputs = True
                 elif path == '/Dc/0/Current':
-                    current = avg_value
+                    self.current = value
+                    power_inputs = True
                 if path == '/System/NrOfModulesOnline':
-                    nr_of_modules_online = int(avg_value)
+                    nr_of_modules_online = int(value)
                 elif path == '/Soc':
-                    self.soc = int(avg_value)
-        if voltage is not None and current is not None:
-            power = round(voltage * current)
+                    self.soc = int(value)
+        if power_inputs and self.voltage is not None and self.current is not None:
+            power = round(self.voltage * self.current)
             logging.info(f"Setting /Dc/0/Power: {power}")
-            self._dbusservice['/Dc/0/Power'] = power
-            updated = True
+            values['/Dc/0/Power'] = power
         if nr_of_modules_online is not None:
             self.installed_capacity = nr_of_modules_online * 94
             logging.info(f"Setting /InstalledCapacity: {self.installed_capacity}")
-            self._dbusservice['/InstalledCapacity'] = self.installed_capacity
-            updated = True
+            values['/InstalledCapacity'] = self.installed_capacity
         if self.installed_capacity and self.soc:
-            self._calculate_available_capacity()
-            updated = True
-        if updated:
-            self.last_dbus_update_time = time.time()
+            values['/Capacity'] = self._calculate_available_capacity()
+        if values:
+            # All paths of the window go out as a single ItemsChanged signal
+            self.publisher.publish(values)
+
+    def _log_statistics(self, now):
+        # Throughput is reported as frames per second and frames per CPU
+        # second of this process, to compare ingestion cost between versions.
+        cpu = time.process_time()
+        downtime = self.downtime
+        if self.down_since is not None:
+            downtime += time.monotonic() - self.down_since
+        if self.reconnects:
+            logging.info(f"CAN source reconnects: {self.reconnects}, downtime: {downtime:.1f} s")
+        if self.can_source is None:
+            self.last_stats_time = now
+            self.last_stats_cpu = cpu
+            return
+        frames = self.can_source.frames_received
+        elapsed = now - self.last_stats_time
+        cpu_used = cpu - self.last_stats_cpu
+        received = frames - self.last_stats_frames
+        frames_per_cpu = received / cpu_used if cpu_used > 0 else 0.0
+        logging.info(f"CAN frames received: {frames}, "
+                     f"dropped by filter: {self.can_source.dropped_frames()}, "
+                     f"throughput: {received / elapsed:.0f} frames/s at {cpu_used / elapsed:.1%} CPU "
+                     f"({frames_per_cpu:.0f} frames per CPU second), "
+                     f"D-Bus signals per window: {self.publisher.signals_per_window():.1f}, "
+                     f"deadband suppression: {self.publisher.suppression_ratio():.0%}, "
+                     f"source switches: {self.arbiter.switches}, "
+                     f"{self.fast_lane.statistics()}")
+        if self.can_source.timeouts:
+            timeouts = ', '.join(f"{format_frame_key(can_id)}: {count}"
+                                 for can_id, count in sorted(self.can_source.timeouts.items()))
+            logging.info(f"CAN ID timeouts: {timeouts}")
+        self.last_stats_time = now
+        self.last_stats_cpu = cpu
+        self.last_stats_frames = frames
+
+    def _expire_paths(self):
+        # Invalidate the paths whose CAN ids have not been received within
+        # their timeout. Returns True when any id is still being received.
+        expiry = self.expiry
+        tick = int(time.monotonic())
+        receiving = False
+        if self.can_source is not None and self.can_source.only_changes:
+            # Unchanged frames are not delivered; ids the source has not
+            # reported as lost are still being sent.
+            for key in expiry.seen.keys() - self.can_source.lost:
+                expiry.seen[key] = tick
+                receiving = True
+        values = {}
+        for path in expiry.tick(tick):
+            if path in self.table_paths:
+                continue
+            logging.warning(f"No data for {path} in {expiry.timeouts[path]} s, invalidating")
+            values[path] = None
+            self.provisional.discard(path)
+            if path in self.accumulators:
+                self.accumulators[path].reset()
+            else:
+                self.fast_lane.paths[path].value = None
+            if path == '/Dc/0/Voltage':
+                self.voltage = None
+                values['/Dc/0/Power'] = None
+            elif path == '/Dc/0/Current':
+                self.current = None
+                values['/Dc/0/Power'] = None
+            elif path == '/Soc':
+                self.soc = 0
+                values['/Capacity'] = None
+            elif path == '/System/NrOfModulesOnline':
+                self.installed_capacity = 0
+                values['/InstalledCapacity'] = None
+                values['/Capacity'] = None
+        if values:
+            self.publisher.publish(values, window=False)
+        return receiving
+
+    def _confirm_restored(self):
+        # A restored path is confirmed once one of its CAN ids was received;
+        # derived paths and paths without expiry with the first frame.
+        seen = self.expiry.seen
+        keys = self.expiry.keys
+        confirmed = set()
+        for path in self.provisional:
+            if path in keys:
+                if any(key in seen for key in keys[path]):
+                    confirmed.add(path)
+            elif self.frames_decoded:
+                confirmed.add(path)
+        if confirmed:
+            self.provisional -= confirmed
+            if not self.provisional:
+                logging.info("All restored values are confirmed by CAN frames")
 
     def _update(self):
         logging.debug("Updating D-Bus battery data...")
         now = time.time()
-        if self.last_valid_can_time and now - self.last_valid_can_time <= CONNECTION_TIMEOUT:
+        if self._expire_paths() or self.frames_decoded != self.frames_seen:
+            self.frames_seen = self.frames_decoded
+            self.last_valid_can_time = now
+            self.last_frame_time = now
+            # Frames are flowing again, the next failure starts a new backoff
+            self.reconnect_delay = RECONNECT_DELAY
+        if self.arbiter.update(self.expiry.seen, self.expiry.now):
+            self._build_handlers()
+        if self.provisional:
+            self._confirm_restored()
+        if self.snapshot is not None:
+            self.snapshot.maybe_save(time.monotonic())
+        if (self.can_source is not None and self.last_valid_can_time
+                and now - self.last_valid_can_time <= CONNECTION_TIMEOUT):
             if self._dbusservice['/Connected'] != 1:
                 logging.info("CAN connection established")
                 self._dbusservice['/Connected'] = 1
@@ -247,15 +795,63 @@ class DbusBatteryService:
             if self._dbusservice['/Connected'] != 0:
                 logging.warning("CAN connection lost")
                 self._dbusservice['/Connected'] = 0
-        if now - self.last_dbus_update_time > 60:
-            logging.error("No D-Bus updates for 60 seconds. Restarting service.")
-            try:
-                if hasattr(self, 'proc') and self.proc.poll() is None:
-                    self.proc.terminate()
-            finally:
-                os._exit(1)
+        if now - self.last_stats_time >= STATS_INTERVAL:
+            self._log_statistics(now)
+        # Derived and table paths are published without new frames, so the
+        # stall check looks at decoded frames instead of D-Bus updates
+        if self.can_source is not None and now - self.last_frame_time > STALL_TIMEOUT:
+            logging.error(f"No CAN frames decoded for {STALL_TIMEOUT} seconds, reopening the CAN source")
+            GLib.source_remove(self.can_watch)
+            self._source_down()
         return True
 
+    def close(self):
+        if self.can_source is not None:
+            self.can_source.close()
+        self.transmitter.close()
+        if self.snapshot is not None and self.snapshot.dirty:
+            self.snapshot.save()
+
 if __name__ == "__main__":
-    service = DbusBatteryService()
-    logging.info('Battery D-Bus service initialized and running.')
+    parser = argparse.ArgumentParser(description='Publish CAN bus BMS data as a Victron battery service')
+    parser.add_argument('--interface', default='any',
+                        help="CAN interface to listen on, e.g. can0 or vcan0, for batteries that do not "
+                             "set one (default: any)")
+    parser.add_argument('--source', default='auto', choices=['auto'] + list(SOURCES),
+                        help="Frame source: raw socket, candump, bcm to only receive changed frames, "
+                             "or auto to fall back to candump")
+    parser.add_argument('--no-per-item-signals', dest='per_item_signals', action='store_false',
+                        help="Only emit one ItemsChanged signal per window, without the PropertiesChanged "
+                             "signal per path that consumers not handling ItemsChanged rely on")
+    parser.add_argument('--snapshot', default=SNAPSHOT_PATH,
+                        help=f"File the last published values are saved to and restored from at startup, "
+                             f"empty to disable (default: {SNAPSHOT_PATH})")
+    parser.add_argument('--lite-export', action='store_true',
+                        help="Serve all D-Bus paths from one object instead of one object per path")
+    args = parser.parse_args()
+    try:
+        batteries = battery_configs(CAN_SECTIONS, args.interface)
+    except (KeyError, ValueError, TypeError) as e:
+        logging.error(f"Invalid batteries section in {CAN_MAPPING_PATH}: {e}")
+        sys.exit(1)
+
+    # All batteries share the main loop. Each service exports the same object
+    # paths, so each needs a private D-Bus connection of its own.
+    DBusGMainLoop(set_as_default=True)
+    bus_type = dbus.bus.BUS_SESSION if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.bus.BUS_SYSTEM
+    services = []
+    for battery in batteries:
+        snapshot_path = args.snapshot
+        if snapshot_path and len(batteries) > 1:
+            base, extension = os.path.splitext(snapshot_path)
+            snapshot_path = f"{base}-{battery['device_instance']}{extension}"
+        services.append(DbusBatteryService(battery, args.source, args.per_item_signals, snapshot_path,
+                                           args.lite_export, dbus.bus.BusConnection(bus_type)))
+    logging.info(f"{len(services)} battery D-Bus service(s) initialized and running.")
+    mainloop = GLib.MainLoop()
+    try:
+        mainloop.run()
+    except KeyboardInterrupt:
+        logging.info("Process interrupted. Stopping the listener.")
+        for service in services:
+            service.close()
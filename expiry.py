@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+
+from can_source import frame_key
+
+# Seconds without a frame after which a path is invalidated when the mapping
+# sets no "timeout"; 0 disables expiry for a path
+DEFAULT_TIMEOUT = 10
+# Slots of the timer wheel, one per second
+WHEEL_SLOTS = 64
+
+
+class TimerWheel:
+    # Hashed timer wheel: an entry for tick t lives in slot t % slots, so
+    # adding an entry and advancing by one tick only touch a single slot,
+    # however many entries there are. Entries further away than one turn
+    # simply stay in their slot until their tick comes around.
+    def __init__(self, now, slots=WHEEL_SLOTS):
+        self.slots = [[] for _ in range(slots)]
+        self.now = now
+
+    def add(self, deadline, item):
+        self.slots[deadline % len(self.slots)].append((deadline, item))
+
+    def advance(self, now):
+        # Move to tick now and return the items that are due
+        due = []
+        size = len(self.slots)
+        for tick in range(max(self.now + 1, now - size + 1), now + 1):
+            slot = self.slots[tick % size]
+            if not slot:
+                continue
+            due.extend(item for deadline, item in slot if deadline <= now)
+            slot[:] = [entry for entry in slot if entry[0] > now]
+        self.now = max(self.now, now)
+        return due
+
+
+class PathExpiry:
+    # Invalidates paths whose CAN ids went quiet. Decoding a frame only
+    # stores the current tick in seen[key]; nothing is rescheduled per frame.
+    # When the wheel reaches the deadline of a path it checks when the path
+    # was last fed: if that was recent enough the path is put back at its new
+    # deadline, otherwise it has expired. A path fed by several ids stays
+    # valid while any of them is received.
+    def __init__(self, mappings, now):
+        self.wheel = TimerWheel(now)
+        self.seen = {}
+        self.started = now
+        self.keys = {}
+        self.timeouts = {}
+        self.expired = set()
+        for can_id, mapping in mappings.items():
+            key = frame_key(can_id)
+            for path, config in mapping.items():
+                timeout = config.get("timeout", DEFAULT_TIMEOUT)
+                if not timeout:
+                    continue
+                self.keys.setdefault(path, []).append(key)
+                self.timeouts[path] = min(timeout, self.timeouts.get(path, timeout))
+        for path, timeout in self.timeouts.items():
+            self.wheel.add(now + timeout, path)
+
+    @property
+    def now(self):
+        return self.wheel.now
+
+    def last_seen(self, path):
+        seen = self.seen
+        return max(seen.get(key, self.started) for key in self.keys[path])
+
+    def tick(self, now):
+        # Advance to now; returns the paths that expired since the last tick
+        expired = []
+        for path in self.wheel.advance(now):
+            deadline = self.last_seen(path) + self.timeouts[path]
+            if deadline > now:
+                self.wheel.add(deadline, path)
+            else:
+                expired.append(path)
+                self.expired.add(path)
+        for path in list(self.expired):
+            if path not in expired and self.last_seen(path) + self.timeouts[path] > now:
+                self.expired.discard(path)
+                self.wheel.add(self.last_seen(path) + self.timeouts[path], path)
+                logging.info(f"{path} is being received again")
+        return expired
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+from array import array
+from functools import partial
+
+from can_mapping import compile_frame
+from can_source import format_frame_key, frame_key
+from expiry import DEFAULT_TIMEOUT
+from scheduler import DEFAULT_INTERVAL
+
+# How the values of all modules are combined into a pack value
+PACK_REDUCERS = ('min', 'max', 'mean', 'sum')
+
+
+class ModuleTable:
+    # Values of a stack of identical modules, each sending the same frame
+    # layout on its own CAN id. Every field of the "modules" section gets an
+    # array with one slot per module that decoded frames are written into
+    # directly. Pack values are computed over the modules that reported
+    # within the timeout, together with the number of the module holding the
+    # minimum or maximum.
+    def __init__(self, config):
+        self.config = config
+        if "can_ids" in config:
+            self.keys = [frame_key(can_id) for can_id in config["can_ids"]]
+        else:
+            base = frame_key(config["base_id"])
+            self.keys = [base + n for n in range(int(config["count"]))]
+        if not self.keys:
+            raise ValueError("no modules")
+        self.count = len(self.keys)
+        self.interval = config.get("interval", DEFAULT_INTERVAL)
+        self.timeout = config.get("timeout", DEFAULT_TIMEOUT)
+        self.fields = {}
+        for name, field in config["fields"].items():
+            reducer = field.get("pack")
+            if reducer is not None and reducer not in PACK_REDUCERS:
+                raise ValueError(f"unknown pack reducer '{reducer}' for {name}")
+            self.fields[name] = field
+        self.tables = {name: array('d', bytes(8 * self.count)) for name in self.fields}
+        # Paths published for the pack, with their precision
+        self.precisions = {}
+        for field in self.fields.values():
+            if field.get("path"):
+                self.precisions[field["path"]] = field.get("precision")
+            if field.get("id_path"):
+                self.precisions[field["id_path"]] = None
+
+    def handlers(self):
+        # (decoder, sinks) per module CAN id in the format of the service's
+        # frame handlers; a sink stores a value in the module's slot.
+        # All modules share one layout, so a single decoder serves them all
+        decoder = compile_frame(format_frame_key(self.keys[0]), self.fields)
+        handlers = {}
+        for n, key in enumerate(self.keys):
+            sinks = tuple(partial(self.tables[name].__setitem__, n) for name in decoder.paths)
+            handlers[key] = (decoder, sinks)
+        return handlers
+
+    def present(self, seen, now):
+        # Numbers of the modules whose frame was seen within the timeout
+        timeout = self.timeout
+        return [n for n, key in enumerate(self.keys) if key in seen and now - seen[key] <= timeout]
+
+    def values(self, seen, now):
+        # Pack values to publish, all invalid while no module reports
+        present = self.present(seen, now)
+        if not present:
+            return dict.fromkeys(self.precisions)
+        return self.pack_values(present)
+
+    def pack_values(self, present):
+        # Pack values over the module numbers in present, which must not be
+        # empty
+        values = {}
+        for name, field in self.fields.items():
+            reducer = field.get("pack")
+            if reducer is None or not field.get("path"):
+                continue
+            table = self.tables[name]
+            column = [table[n] for n in present]
+            if reducer == 'min':
+                value = min(column)
+            elif reducer == 'max':
+                value = max(column)
+            elif reducer == 'sum':
+                value = sum(column)
+            else:
+                value = sum(column) / len(column)
+            values[field["path"]] = value
+            if field.get("id_path") and reducer in ('min', 'max'):
+                values[field["id_path"]] = f"M{present[column.index(value)] + 1}"
+        return values
+
+
+def module_table(config):
+    # ModuleTable for a "modules" section, None without one or when invalid
+    if not config:
+        return None
+    try:
+        return ModuleTable(config)
+    except (KeyError, TypeError, ValueError) as e:
+        logging.error(f"Invalid modules section: {e}, ignoring it")
+        return None
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+# Seconds a path with a deadband may go without an update when no max_hold is
+# configured
+DEFAULT_MAX_HOLD = 30
+# Target in seconds from reading a frame to publishing a fast lane change
+FAST_LANE_LATENCY_TARGET = 0.05
+
+
+def round_to_precision(value, precision):
+    if precision is None:
+        return value
+    return float(f"{value:.{precision}f}")
+
+
+class Deadband:
+    # Change threshold of one path. An update is skipped while it differs
+    # from the last published value by no more than the absolute or relative
+    # band, unless the last update is older than hold seconds.
+    __slots__ = ('absolute', 'relative', 'hold', 'value', 'time')
+
+    def __init__(self, absolute=0, relative=0, hold=DEFAULT_MAX_HOLD):
+        self.absolute = absolute
+        self.relative = relative
+        self.hold = hold
+        self.value = None
+        self.time = None
+
+    def suppress(self, value, now):
+        last = self.value
+        if last is not None and value is not None and now - self.time < self.hold:
+            if abs(value - last) <= max(self.absolute, self.relative * abs(last)):
+                return True
+        self.value = value
+        self.time = now
+        return False
+
+
+def make_deadbands(mappings):
+    # Deadbands for the paths that configure one in can-mappings.json
+    deadbands = {}
+    for can_id in mappings:
+        for path, config in mappings[can_id].items():
+            if path in deadbands:
+                continue
+            if "deadband" in config or "deadband_rel" in config:
+                deadbands[path] = Deadband(config.get("deadband", 0), config.get("deadband_rel", 0),
+                                           config.get("max_hold", DEFAULT_MAX_HOLD))
+    return deadbands
+
+
+class Publisher:
+    # Writes a window of values to the VeDbusService through a ServiceContext,
+    # so all changed paths go out as one ItemsChanged signal on the root
+    # object. With per_item_signals, the default, each changed path also
+    # emits its PropertiesChanged signal for consumers that only listen to
+    # those; turning it off leaves one signal per window.
+    # Paths with a deadband are left alone while their change is noise.
+    # Every callable in listeners is called with the changes of a publish.
+    def __init__(self, service, per_item_signals=True, deadbands=None):
+        self.service = service
+        self.per_item_signals = per_item_signals
+        self.deadbands = deadbands or {}
+        self.listeners = []
+        self.windows = 0
+        self.signals = 0
+        self.considered = 0
+        self.suppressed = 0
+
+    def publish(self, values, window=True):
+        # Returns the paths whose value actually changed. Only window
+        # publishes count towards the signals per window statistic.
+        now = time.monotonic()
+        deadbands = self.deadbands
+        with self.service as context:
+            for path, value in values.items():
+                deadband = deadbands.get(path)
+                if deadband is not None:
+                    self.considered += 1
+                    if deadband.suppress(value, now):
+                        self.suppressed += 1
+                        continue
+                context[path] = value
+            changes = dict(context.changes)
+        signals = 1 if changes else 0
+        if self.per_item_signals:
+            for path, change in changes.items():
+                self.service._dbusobjects[path].PropertiesChanged(change)
+            signals += len(changes)
+        if changes:
+            for listener in tuple(self.listeners):
+                listener(changes)
+        if window:
+            self.windows += 1
+            self.signals += signals
+        logging.debug(f"Published {len(changes)} changed paths with {signals} D-Bus signals")
+        return changes
+
+    def set_deadbands(self, deadbands):
+        # Replace the deadbands, keeping the last published value and time of
+        # paths that have one in both
+        for path, deadband in deadbands.items():
+            old = self.deadbands.get(path)
+            if old is not None:
+                deadband.value = old.value
+                deadband.time = old.time
+        self.deadbands = deadbands
+
+    def signals_per_window(self):
+        return self.signals / self.windows if self.windows else 0.0
+
+    def suppression_ratio(self):
+        # Share of deadband path updates that were skipped
+        return self.suppressed / self.considered if self.considered else 0.0
+
+
+class FastPath:
+    # Sink for a path that bypasses the publish window: a decoded value that
+    # differs from the previous one is queued for immediate publishing.
+    __slots__ = ('path', 'pending', 'value')
+
+    def __init__(self, path, pending):
+        self.path = path
+        self.pending = pending
+        self.value = None
+
+    def add(self, value):
+        if value != self.value:
+            self.value = value
+            self.pending[self.path] = value
+
+
+class FastLane:
+    # Paths flagged "fast" in can-mappings.json, such as alarms and charge
+    # limits, are published as soon as a change is decoded. Latency is
+    # measured from the moment the frame was read to the end of the publish.
+    def __init__(self, publisher, precisions, target=FAST_LANE_LATENCY_TARGET):
+        self.publisher = publisher
+        self.target = target
+        self.pending = {}
+        self.paths = {}
+        self.configure(precisions)
+        self.updates = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.over_target = 0
+
+    def configure(self, precisions):
+        # Set the fast paths and their precision; paths that stay fast keep
+        # their last value
+        self.precisions = precisions
+        self.paths = {path: self.paths.get(path) or FastPath(path, self.pending) for path in precisions}
+        for path in list(self.pending):
+            if path not in precisions:
+                del self.pending[path]
+
+    def flush(self, received):
+        values = {path: round_to_precision(value, self.precisions[path])
+                  for path, value in self.pending.items()}
+        self.pending.clear()
+        for path, value in values.items():
+            logging.info(f"Setting {path} (fast lane): {value}")
+        self.publisher.publish(values, window=False)
+        latency = time.monotonic() - received
+        self.updates += 1
+        self.total_latency += latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+        if latency > self.target:
+            self.over_target += 1
+            logging.warning(f"Fast lane update took {latency * 1000:.1f} ms, "
+                            f"target is {self.target * 1000:.0f} ms")
+
+    def statistics(self):
+        mean = self.total_latency / self.updates if self.updates else 0.0
+        return (f"fast lane updates: {self.updates}, latency mean {mean * 1000:.1f} ms, "
+                f"max {self.max_latency * 1000:.1f} ms, over target: {self.over_target}")
+
+
+def fast_paths(mappings):
+    # Precision of every path flagged "fast" in can-mappings.json. A path fed
+    # by several CAN ids takes its options from its first entry, as with
+    # publish_intervals() and the reducers.
+    paths = {}
+    seen = set()
+    for can_id in mappings:
+        for path, config in mappings[can_id].items():
+            if path in seen:
+                continue
+            seen.add(path)
+            if config.get("fast"):
+                paths[path] = config.get("precision")
+    return paths
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Publish interval in seconds for paths that do not configure one
+DEFAULT_INTERVAL = 2
+
+
+def aligned(now, interval):
+    # Next multiple of interval on the monotonic clock after now. Aligning
+    # windows makes groups whose intervals divide each other close together.
+    return (now // interval + 1) * interval
+
+
+class PublishGroup:
+    __slots__ = ('interval', 'paths', 'deadline')
+
+    def __init__(self, interval, paths, deadline):
+        self.interval = interval
+        self.paths = paths
+        self.deadline = deadline
+
+
+class PublishScheduler:
+    # Paths are grouped by their publish interval; every group keeps its own
+    # deadline. due() collects all groups whose deadline has passed so they
+    # can be flushed together with a single publish. Window boundaries are
+    # aligned to multiples of the interval. The first window of slow groups is
+    # kept short so every path shows up soon after startup.
+    def __init__(self, intervals, now):
+        by_interval = {}
+        for path, interval in intervals.items():
+            by_interval.setdefault(interval, []).append(path)
+        self.groups = [PublishGroup(interval, tuple(paths), aligned(now, min(interval, DEFAULT_INTERVAL)))
+                       for interval, paths in sorted(by_interval.items())]
+        self.next_deadline = min((group.deadline for group in self.groups), default=None)
+
+    def due(self, now):
+        paths = []
+        for group in self.groups:
+            if now >= group.deadline:
+                paths.extend(group.paths)
+                # Skips missed windows instead of catching up with a burst
+                group.deadline = aligned(now, group.interval)
+        self.next_deadline = min((group.deadline for group in self.groups), default=None)
+        return paths
+
+
+def publish_intervals(mappings):
+    # Fast lane paths are published on change and have no interval. The
+    # first entry of a path decides, as with fast_paths().
+    intervals = {}
+    seen = set()
+    for can_id in mappings:
+        for path, config in mappings[can_id].items():
+            if path in seen:
+                continue
+            seen.add(path)
+            if not config.get("fast"):
+                intervals[path] = config.get("interval", DEFAULT_INTERVAL)
+    return intervals
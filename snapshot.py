@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import os
+import struct
+import time
+import zlib
+
+# File layout: a header followed by one fixed size record per path. Paths are
+# stored as the CRC32 of their name, so every record has the same size and
+# paths that are no longer published are simply ignored on load.
+MAGIC = b'CBS1'
+VERSION = 1
+# magic, version, number of records, time saved (epoch seconds), CRC32 of the records
+HEADER = struct.Struct('<4sHHdI')
+# CRC32 of the path, value
+RECORD = struct.Struct('<Id')
+# Minimum seconds between two writes, to spare the flash
+SNAPSHOT_INTERVAL = 300
+# Snapshots older than this many seconds are not restored
+SNAPSHOT_MAX_AGE = 3600
+
+
+def path_id(path):
+    return zlib.crc32(path.encode())
+
+
+class Snapshot:
+    # Keeps the last published value of every path and writes them to a
+    # small file, at most once per interval and only when something changed.
+    # At startup the file gives the service values to publish before the
+    # first window. The file is replaced atomically, so a power cut leaves
+    # either the old or the new snapshot.
+    def __init__(self, filename, interval=SNAPSHOT_INTERVAL, max_age=SNAPSHOT_MAX_AGE):
+        self.filename = filename
+        self.interval = interval
+        self.max_age = max_age
+        self.values = {}
+        self.dirty = False
+        self.last_save = time.monotonic()
+        self.saves = 0
+
+    def load(self, paths):
+        # Values of the given paths found in the snapshot
+        try:
+            with open(self.filename, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return {}
+        except OSError as e:
+            logging.warning(f"Cannot read snapshot {self.filename}: {e}")
+            return {}
+        try:
+            magic, version, count, saved, crc = HEADER.unpack_from(content)
+        except struct.error:
+            magic = None
+        records = content[HEADER.size:]
+        if (magic != MAGIC or version != VERSION or len(records) != count * RECORD.size
+                or zlib.crc32(records) != crc):
+            logging.warning(f"Ignoring invalid snapshot {self.filename}")
+            return {}
+        age = time.time() - saved
+        if age > self.max_age:
+            logging.info(f"Ignoring snapshot {self.filename} from {age:.0f} s ago")
+            return {}
+        ids = {path_id(path): path for path in paths}
+        values = {}
+        for key, value in RECORD.iter_unpack(records):
+            path = ids.get(key)
+            if path is not None:
+                values[path] = value
+        self.values.update(values)
+        return values
+
+    def update(self, changes):
+        # Publisher listener; invalidated paths are dropped from the snapshot
+        for path, change in changes.items():
+            value = change['Value']
+            if isinstance(value, (int, float)):
+                self.values[path] = value
+            else:
+                self.values.pop(path, None)
+        self.dirty = True
+
+    def maybe_save(self, now):
+        if self.dirty and now - self.last_save >= self.interval:
+            self.save()
+            self.last_save = now
+
+    def save(self):
+        records = b''.join(RECORD.pack(path_id(path), value) for path, value in self.values.items())
+        header = HEADER.pack(MAGIC, VERSION, len(self.values), time.time(), zlib.crc32(records))
+        temporary = self.filename + '.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(header + records)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.filename)
+        except OSError as e:
+            logging.error(f"Cannot write snapshot {self.filename}: {e}")
+            return
+        self.dirty = False
+        self.saves += 1
+        logging.debug(f"Saved {len(self.values)} values to {self.filename}")
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from can_mapping import compile_mappings, validate_mappings
+from can_source import frame_key
+
+
+class ByteRangeTest(unittest.TestCase):
+    MAPPINGS = {
+        "100": {
+            "/Dc/0/Voltage": {"bytes": [0, 1], "type": "U16", "scale": 0.01},
+            "/Soc": {"bytes": [8], "type": "U8"},
+        }
+    }
+
+    def test_out_of_range_entry_is_skipped(self):
+        with self.assertLogs(level='ERROR'):
+            decoder = compile_mappings(self.MAPPINGS)[frame_key("100")]
+        self.assertEqual(decoder.paths, ('/Dc/0/Voltage',))
+        self.assertEqual(decoder.decode(bytes.fromhex('1450000000000000')), (52.0,))
+
+    def test_out_of_range_entry_is_rejected(self):
+        self.assertEqual(validate_mappings(self.MAPPINGS),
+                         ["100 -> /Soc: bytes must be between 0 and 7"])
+
+
+if __name__ == '__main__':
+    unittest.main()
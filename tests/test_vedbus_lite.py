@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+try:
+    import dbus
+    from vedbus_lite import LiteDbusService
+except ImportError:
+    dbus = None
+
+
+@unittest.skipIf(dbus is None, "dbus-python is not installed")
+class LiteItemTest(unittest.TestCase):
+    def setUp(self):
+        self.bus = mock.MagicMock()
+        self.service = LiteDbusService('com.victronenergy.battery.test', self.bus, register=False)
+        self.service.add_path('/Soc', None)
+
+    def test_set_value_signals_item_path(self):
+        self.service['/Soc'] = 50
+        self.assertEqual(self.service['/Soc'], 50)
+        message = self.bus.send_message.call_args[0][0]
+        self.assertEqual(message.get_path(), '/Soc')
+        self.assertEqual(message.get_member(), 'PropertiesChanged')
+        self.assertEqual(message.get_args_list()[0]['Value'], 50)
+
+    def test_unchanged_value_is_not_signalled(self):
+        self.service['/Soc'] = 50
+        self.bus.send_message.reset_mock()
+        self.service['/Soc'] = 50
+        self.bus.send_message.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import os
+
+import dbus
+import dbus.exceptions
+import dbus.lowlevel
+import dbus.service
+
+from ve_utils import unwrap_dbus_value, wrap_dbus_value
+from vedbus import ServiceContext
+
+BUSITEM = 'com.victronenergy.BusItem'
+
+
+class LiteItem:
+    # Value of one path. Behaves like VeDbusItemExport towards the service
+    # and ServiceContext, but is a plain object: the D-Bus side is handled by
+    # the single LiteRootExport.
+    __slots__ = ('service', 'path', 'value', 'description', 'writeable',
+                 'onchangecallback', 'gettextcallback', 'valuetype')
+
+    def __init__(self, service, path, value=None, description=None, writeable=False,
+                 onchangecallback=None, gettextcallback=None, valuetype=None):
+        self.service = service
+        self.path = path
+        self.value = value
+        self.description = description
+        self.writeable = writeable
+        self.onchangecallback = onchangecallback
+        self.gettextcallback = gettextcallback
+        self.valuetype = valuetype
+
+    def local_set_value(self, newvalue):
+        changes = self._local_set_value(newvalue)
+        if changes is not None:
+            self.PropertiesChanged(changes)
+
+    def _local_set_value(self, newvalue):
+        if self.value == newvalue:
+            return None
+        self.value = newvalue
+        return {
+            'Value': wrap_dbus_value(newvalue),
+            'Text': self.GetText()
+        }
+
+    def local_get_value(self):
+        return self.value
+
+    def SetValue(self, newvalue):
+        # Same return codes as VeDbusItemExport: 0 ok, 1 not writeable or
+        # wrong type, 2 rejected by the callback
+        if not self.writeable:
+            return 1
+        newvalue = unwrap_dbus_value(newvalue)
+        if self.valuetype is not None and newvalue is not None:
+            try:
+                newvalue = self.valuetype(newvalue)
+            except (ValueError, TypeError):
+                return 1
+        if newvalue == self.value:
+            return 0
+        if self.onchangecallback is None or self.onchangecallback(self.path, newvalue):
+            self.local_set_value(newvalue)
+            return 0
+        return 2
+
+    def GetText(self):
+        if self.value is None:
+            return '---'
+        if self.gettextcallback is not None:
+            return self.gettextcallback(self.path, self.value)
+        if type(self.value) == dbus.Byte:
+            return str(int(self.value))
+        if self.path == '/ProductId':
+            return "0x%X" % self.value
+        return str(self.value)
+
+    def PropertiesChanged(self, changes):
+        self.service._dbusnodes['/'].item_changed(self.path, changes)
+
+
+class LiteRootExport(dbus.service.FallbackObject):
+    # One fallback object registered at '/' answers the BusItem calls for
+    # every path below it. A path with a value behaves like an item, any
+    # other prefix like a tree node returning the values underneath.
+    def __init__(self, bus, service):
+        dbus.service.FallbackObject.__init__(self, bus, '/')
+        self._service = service
+
+    def _item(self, path):
+        return self._service._dbusobjects.get(path)
+
+    def _subtree(self, path, get_text=False):
+        prefix = path if path.endswith('/') else path + '/'
+        values = {}
+        for p, item in self._service._dbusobjects.items():
+            if p.startswith(prefix):
+                values[p[len(prefix):]] = item.GetText() if get_text else wrap_dbus_value(item.local_get_value())
+        if not values:
+            raise dbus.exceptions.DBusException(f"No such path {path}",
+                                                name='org.freedesktop.DBus.Error.UnknownObject')
+        return values
+
+    @dbus.service.method(BUSITEM, out_signature='v', rel_path_keyword='path')
+    def GetValue(self, path):
+        item = self._item(path)
+        if item is not None:
+            return wrap_dbus_value(item.local_get_value())
+        return dbus.Dictionary(self._subtree(path), signature=dbus.Signature('sv'), variant_level=1)
+
+    # Items return a string and tree nodes a variant with a dictionary, as
+    # with VeDbusItemExport and VeDbusTreeExport, so the signature is taken
+    # from the returned value.
+    @dbus.service.method(BUSITEM, rel_path_keyword='path')
+    def GetText(self, path):
+        item = self._item(path)
+        if item is not None:
+            return dbus.String(item.GetText())
+        return dbus.Dictionary(self._subtree(path, True), signature=dbus.Signature('ss'), variant_level=1)
+
+    @dbus.service.method(BUSITEM, in_signature='v', out_signature='i', rel_path_keyword='path')
+    def SetValue(self, newvalue, path):
+        item = self._item(path)
+        if item is None:
+            return 1
+        return item.SetValue(newvalue)
+
+    @dbus.service.method(BUSITEM, in_signature='si', out_signature='s', rel_path_keyword='path')
+    def GetDescription(self, language, length, path):
+        item = self._item(path)
+        if item is None or item.description is None:
+            return 'No description given'
+        return item.description
+
+    @dbus.service.method(BUSITEM, out_signature='a{sa{sv}}', rel_path_keyword='path')
+    def GetItems(self, path):
+        return {
+            p: {
+                'Value': wrap_dbus_value(item.local_get_value()),
+                'Text': item.GetText()}
+            for p, item in self._service._dbusobjects.items()
+        }
+
+    @dbus.service.signal(BUSITEM, signature='a{sa{sv}}')
+    def ItemsChanged(self, changes):
+        pass
+
+    @dbus.service.signal(BUSITEM, signature='a{sv}')
+    def PropertiesChanged(self, changes):
+        pass
+
+    def item_changed(self, path, changes):
+        # dbus-python emits the signals of a fallback object from its own path
+        # followed by the relative path, which gives '//Soc' for an object at
+        # '/', so the signal of an item is sent as a message from its path
+        if path == '/':
+            self.PropertiesChanged(changes)
+            return
+        message = dbus.lowlevel.SignalMessage(path, BUSITEM, 'PropertiesChanged')
+        message.append(changes, signature='a{sv}')
+        for location in self.locations:
+            location[0].send_message(message)
+
+
+class LiteDbusService:
+    # Drop-in for the parts of VeDbusService this service uses. Instead of a
+    # dbus.service.Object per path and per tree node, all paths are kept in a
+    # flat table and exported through one fallback object, which saves memory
+    # and registration time while staying compatible with the BusItem
+    # interface on the wire.
+    def __init__(self, servicename, bus=None, register=True):
+        self._dbusobjects = {}
+        self._ratelimiters = []
+        self._dbusname = None
+        self.name = servicename
+        self._dbusconn = bus or (dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus())
+        self.dbusconn = self._dbusconn
+        self._dbusnodes = {'/': LiteRootExport(self._dbusconn, self)}
+        if register:
+            self.register()
+
+    def register(self):
+        self._dbusname = dbus.service.BusName(self.name, self._dbusconn, do_not_queue=True)
+        logging.info(f"registered ourselves on D-Bus as {self.name} with a single object")
+
+    def get_name(self):
+        return self._dbusname.get_name()
+
+    def add_path(self, path, value, description="", writeable=False,
+                 onchangecallback=None, gettextcallback=None, valuetype=None, itemtype=None):
+        item = LiteItem(self, path, value, description, writeable, onchangecallback, gettextcallback, valuetype)
+        self._dbusobjects[path] = item
+        logging.debug(f"added {path} with start value {value}. Writeable is {writeable}")
+        return item
+
+    def __getitem__(self, path):
+        return self._dbusobjects[path].local_get_value()
+
+    def __setitem__(self, path, newvalue):
+        self._dbusobjects[path].local_set_value(newvalue)
+
+    def __delitem__(self, path):
+        del self._dbusobjects[path]
+
+    def __contains__(self, path):
+        return path in self._dbusobjects
+
+    def __enter__(self):
+        context = ServiceContext(self)
+        self._ratelimiters.append(context)
+        return context
+
+    def __exit__(self, *exc):
+        if self._ratelimiters:
+            self._ratelimiters.pop().flush()